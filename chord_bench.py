@@ -0,0 +1,302 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import shlex
+import subprocess
+import sys
+import time
+from bisect import bisect
+from concurrent.futures import ThreadPoolExecutor
+
+from chord_populate import chord_populate
+from chord_query import chord_query
+from chord_ring import CONSISTENCY_LEVELS, ONE, hash_key
+from chord_stats import print_report, summary
+
+TEST_BASE = 43544
+M = 3  # FIXME: Test environment, normally = hashlib.sha1().digest_size * 8
+KEYS = 10000  # keys bulk-loaded before the run
+VALUE_SIZE = 100  # bytes per value
+CONCURRENCY = 8  # client threads issuing operations
+DURATION = 10.0  # seconds the workload runs
+READ_RATIO = 0.9  # share of operations that are reads, the rest are writes
+UNIFORM = 'uniform'
+ZIPF = 'zipf'  # key rank r is chosen with weight 1 / r ** s
+DISTRIBUTIONS = (UNIFORM, ZIPF)
+START_TIMEOUT = 30.0  # seconds a launched ring has to link up
+OPERATIONS = ('read', 'write')
+
+
+class KeyChooser(object):
+    """
+    Draws key indexes in [0, count), uniformly or with Zipf skew.
+
+    For Zipf the cumulative weights are built once and every draw is one bisection.
+
+    >>> chooser = KeyChooser(1000, ZIPF, 1.2)
+    >>> rng = random.Random(1)
+    >>> draws = [chooser.choose(rng) for i in range(10000)]
+    >>> draws.count(0) > draws.count(10) > draws.count(500)
+    True
+    """
+
+    def __init__(self, count, distribution=UNIFORM, s=1.0):
+        self.count = count
+        self.cumulative = None
+        if distribution == ZIPF:
+            self.cumulative = list(itertools.accumulate(1.0 / r ** s for r in range(1, count + 1)))
+
+    def choose(self, rng):
+        if self.cumulative is None:
+            return rng.randrange(self.count)
+        return min(bisect(self.cumulative, rng.random() * self.cumulative[-1]), self.count - 1)
+
+
+'''
+    Node ids spread evenly over the identifier space
+    @:return: [node number, ...]'''
+def spread_ids(count, m=M):
+    if count > 2 ** m:
+        raise ValueError('a ring of {} ids has no room for {} nodes'.format(2 ** m, count))
+    return sorted(set(i * 2 ** m // count for i in range(count)))
+
+
+class LocalRing(object):
+    """
+    A ring of chord_node.py processes on localhost, started one join at a time and killed on close.
+    """
+
+    def __init__(self, ids, node_args=(), log_dir=None):
+        self.ids = ids
+        self.node_args = list(node_args)
+        self.log_dir = log_dir
+        self.processes = []
+
+    @property
+    def entry_port(self):
+        return TEST_BASE + self.ids[0]
+
+    def start(self, timeout=START_TIMEOUT):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chord_node.py')
+        for i, n in enumerate(self.ids):
+            existing = 0 if i == 0 else self.entry_port
+            if self.log_dir:
+                log = open(os.path.join(self.log_dir, 'node{}.log'.format(n)), 'w')
+            else:
+                log = subprocess.DEVNULL
+            self.processes.append(subprocess.Popen(
+                [sys.executable, script, str(existing), str(n)] + self.node_args, stdout=log, stderr=log))
+            self.wait_for(self.ids[:i + 1], timeout)
+
+    '''
+        Waits until walking the ring from the entry node finds exactly ids
+        raises RuntimeError after timeout seconds'''
+    def wait_for(self, ids, timeout):
+        query = chord_query(cache_size=0)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                query.ring.refresh(self.entry_port, None)
+                if query.ring.nodes == sorted(ids):
+                    return
+            except OSError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError('ring did not link up: expected {}, saw {}'.format(sorted(ids), query.ring.nodes))
+            time.sleep(0.1)
+
+    def close(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait()
+
+
+class Bench(object):
+    """
+    Bulk-loads a synthetic dataset into a ring and runs a read/write mix against it from many threads.
+
+    Keys are named key0 .. key{count-1} and hashed like any other key, so skew in the names
+    becomes skew over the nodes that own them. Reads go through chord_query and writes through
+    chord_populate, as a real client's would; latencies are kept per operation for the report.
+    """
+
+    def __init__(self, entry_port, keys=KEYS, value_size=VALUE_SIZE, replicas=1, consistency=ONE):
+        self.entry_port = entry_port
+        self.keys = keys
+        self.value_size = value_size
+        self.query = chord_query(replicas=replicas, consistency=consistency, cache_size=0)
+        self.populate = chord_populate(consistency=consistency)
+        self.ids = [hash_key('key{}'.format(i)) for i in range(keys)]
+
+    def value(self, i, rng=None):
+        tag = 'v{}:{}:'.format(i, rng.getrandbits(32) if rng else 0)
+        return tag.ljust(self.value_size, 'x')
+
+    '''
+        Saves every key once, grouped by owner node like chord_populate's bulk load
+        @:return: {'keys': ..., 'seconds': ..., 'keys_per_sec': ...}'''
+    def load(self, batch_size=1000):
+        started = time.perf_counter()
+        for i in range(0, self.keys, batch_size):
+            batch = {self.ids[j]: self.value(j) for j in range(i, min(i + batch_size, self.keys))}
+            for node_add, dic in self.populate.group_by_node(self.entry_port, batch).items():
+                self.populate.deliver(self.entry_port, node_add, dic)
+        seconds = time.perf_counter() - started
+        return {'keys': self.keys, 'seconds': seconds, 'keys_per_sec': self.keys / max(seconds, 1e-9)}
+
+    def read(self, i, rng):
+        id = self.ids[i]
+        if id not in self.query.fetch_ids(self.entry_port, [id]):
+            raise KeyError(id)
+
+    def write(self, i, rng):
+        id = self.ids[i]
+        self.populate.deliver(self.entry_port, self.populate.ring.owner(self.entry_port, id),
+                              {id: self.value(i, rng)})
+
+    '''
+        One client thread: issues operations until the deadline or until the shared budget runs out
+        @:return: {operation: ([latency, ...], errors)}'''
+    def client(self, chooser, read_ratio, deadline, budget, seed):
+        rng = random.Random(seed)
+        results = {op: ([], 0) for op in OPERATIONS}
+        while time.perf_counter() < deadline and (budget is None or next(budget) > 0):
+            op = 'read' if rng.random() < read_ratio else 'write'
+            i = chooser.choose(rng)
+            started = time.perf_counter()
+            try:
+                getattr(self, op)(i, rng)
+            except Exception:
+                latencies, errors = results[op]
+                results[op] = latencies, errors + 1
+                continue
+            results[op][0].append(time.perf_counter() - started)
+        return results
+
+    '''
+        Runs the workload with concurrency threads for duration seconds, or until ops operations are done
+        @:return: report dict'''
+    def run(self, concurrency=CONCURRENCY, duration=DURATION, ops=None, read_ratio=READ_RATIO,
+            distribution=UNIFORM, zipf_s=1.0, seed=None):
+        chooser = KeyChooser(self.keys, distribution, zipf_s)
+        budget = itertools.count(ops, -1) if ops else None  # next() is atomic, so threads share it safely
+        seeds = random.Random(seed)
+        started = time.perf_counter()
+        deadline = started + duration if duration else float('inf')
+        with ThreadPoolExecutor(concurrency) as executor:
+            futures = [executor.submit(self.client, chooser, read_ratio, deadline, budget, seeds.random())
+                       for i in range(concurrency)]
+            results = [future.result() for future in futures]
+        elapsed = time.perf_counter() - started
+        report = {'seconds': elapsed}
+        total = 0
+        for op in OPERATIONS:
+            latencies = [t * 1000 for result in results for t in result[op][0]]
+            total += len(latencies)
+            report[op] = {
+                'ops': len(latencies),
+                'errors': sum(result[op][1] for result in results),
+                'ops_per_sec': len(latencies) / elapsed,
+                'latency_ms': summary(latencies),
+            }
+        report['ops'] = total
+        report['ops_per_sec'] = total / elapsed
+        return report
+
+
+'''
+    Compares a report with a baseline one: throughput and latency percentiles as relative changes
+    a regression is throughput down or p99 latency up by more than threshold
+    @:return: ({metric: change}, [regressed metric, ...])'''
+def compare(report, baseline, threshold):
+    changes = {}
+    regressions = []
+    for op in OPERATIONS:
+        new, old = report['run'][op], baseline['run'][op]
+        if not new['ops'] or not old['ops']:
+            continue
+        change = new['ops_per_sec'] / old['ops_per_sec'] - 1
+        changes['{}.ops_per_sec'.format(op)] = change
+        if change < -threshold:
+            regressions.append('{}.ops_per_sec'.format(op))
+        for p in ('p50', 'p95', 'p99'):
+            change = new['latency_ms'][p] / old['latency_ms'][p] - 1
+            changes['{}.latency_ms.{}'.format(op, p)] = change
+            if p == 'p99' and change > threshold:
+                regressions.append('{}.latency_ms.{}'.format(op, p))
+    return changes, regressions
+
+
+'''
+    Main method: starts a --nodes node ring on localhost (or uses the one at --entry PORT),
+    bulk-loads --keys keys of --value-size bytes and runs a --read-ratio read/write mix
+    from --concurrency threads for --duration seconds (or --ops operations)
+    --distribution : uniform or zipf key choice, --zipf-s sets the skew
+    --node-args : extra chord_node.py arguments for the launched nodes, e.g. "--replicas 2 --vnodes 2"
+    --replicas, --consistency : as for chord_query.py and chord_populate.py
+    --output FILE : also write the JSON report to FILE, e.g. to keep it as a baseline
+    --baseline FILE : compare with a stored report, exit status 1 if throughput drops
+    or p99 latency grows by more than --max-regression (a fraction)'''
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage='python chord_bench.py [--nodes N | --entry PORT] [--node-args ARGS] '
+                                           '[--keys N] [--value-size BYTES] [--concurrency N] '
+                                           '[--duration S] [--ops N] [--read-ratio R] '
+                                           '[--distribution uniform|zipf] [--zipf-s S] [--replicas R] '
+                                           '[--consistency one|quorum|all] [--seed N] [--log-dir DIR] '
+                                           '[--output FILE] [--baseline FILE] [--max-regression R] [--text]')
+    parser.add_argument('--nodes', type=int, default=4)
+    parser.add_argument('--entry', type=int)
+    parser.add_argument('--node-args', default='')
+    parser.add_argument('--keys', type=int, default=KEYS)
+    parser.add_argument('--value-size', type=int, default=VALUE_SIZE)
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY)
+    parser.add_argument('--duration', type=float, default=DURATION)
+    parser.add_argument('--ops', type=int)
+    parser.add_argument('--read-ratio', type=float, default=READ_RATIO)
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS, default=UNIFORM)
+    parser.add_argument('--zipf-s', type=float, default=1.0)
+    parser.add_argument('--replicas', type=int, default=1)
+    parser.add_argument('--consistency', choices=CONSISTENCY_LEVELS, default=ONE)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--log-dir')
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    parser.add_argument('--max-regression', type=float, default=0.1)
+    parser.add_argument('--text', action='store_true')
+    args = parser.parse_args()
+    if args.ops:
+        args.duration = 0
+    ring = None
+    if args.entry is None:
+        ring = LocalRing(spread_ids(args.nodes), shlex.split(args.node_args), args.log_dir)
+    try:
+        if ring:
+            ring.start()
+        bench = Bench(args.entry or ring.entry_port, args.keys, args.value_size, args.replicas, args.consistency)
+        report = {
+            'config': {key: value for key, value in vars(args).items()
+                       if key not in ('output', 'baseline', 'max_regression', 'text', 'log_dir')},
+            'load': bench.load(),
+            'run': bench.run(args.concurrency, args.duration, args.ops, args.read_ratio,
+                             args.distribution, args.zipf_s, args.seed),
+        }
+    finally:
+        if ring:
+            ring.close()
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['baseline'], regressions = compare(report, json.load(f), args.max_regression)
+        report['regressions'] = regressions
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.text:
+        print_report(report)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,306 @@
+import argparse
+import json
+import os
+import socket
+import stat
+import sys
+import time
+
+TEST_BASE = 43544
+SOCKET_NAME = 'chord-client-{}.sock'  # daemon socket, formatted with the entry node's port
+SOCKET_DIR = '/tmp/chord-client-{}'  # private directory for it, formatted with the uid, if XDG_RUNTIME_DIR is not set
+COMMANDS = ('get', 'put', 'refresh', 'stats', 'ping')
+
+
+class ChordClient(object):
+    """
+    Resident client: one chord_query and one chord_populate sharing a ring cache, kept warm across requests.
+
+    The ring is learnt once when the client starts, key owners after that come from the ring cache and
+    rpcs go over the pooled connections opened by earlier requests, so a warm get costs one rpc and
+    no connect or find_successor walk. Import it, or run it as a daemon behind a Unix socket (--serve).
+    """
+
+    def __init__(self, existing_port, lookup=None, replicas=1, consistency=None, cache_size=None, cache_ttl=None):
+        # imported here rather than at the top so that the thin client (sending one command to a
+        # running daemon) starts without loading the ring, rpc and store modules
+        from chord_populate import chord_populate
+        from chord_query import CACHE_TTL, chord_query
+        from chord_ring import ITERATIVE, ONE, hash_key
+        from chord_rpc import POOL
+        from chord_stats import Histogram, RpcStats
+        lookup = lookup or ITERATIVE
+        consistency = consistency or ONE
+        self.existing_port = existing_port
+        self.query = chord_query(lookup, replicas, consistency,
+                                 cache_size=cache_size or 0,
+                                 cache_ttl=CACHE_TTL if cache_ttl is None else cache_ttl)
+        self.populate = chord_populate(lookup, consistency)
+        self.populate.ring = self.query.ring  # one ring cache, refreshed by whichever side finds it stale
+        self.hash_key = hash_key
+        self.pool = POOL
+        self.histogram = Histogram
+        self.requests = RpcStats()  # latency of every get, put, ... asked of this client
+        self.refresh()
+
+    def refresh(self):
+        """ Relearn the ring from the entry node, returns the node ids """
+        self.query.ring.refresh(self.existing_port)
+        return self.query.ring.nodes
+
+    def get(self, key):
+        """ Value of key, None if it is not stored """
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """ {key: value} for those of keys that are stored """
+        started = time.perf_counter()
+        ids = {key: self.hash_key(key) for key in keys}
+        try:
+            values = self.query.fetch_ids(self.existing_port, set(ids.values()))
+        except Exception:
+            self.requests.record('get', time.perf_counter() - started, 0, len(keys), True)
+            raise
+        found = {key: values[id] for key, id in ids.items() if id in values}
+        self.requests.record('get', time.perf_counter() - started, len(found), len(keys))
+        return found
+
+    def put(self, key, value):
+        self.put_many({key: value})
+
+    def put_many(self, pairs):
+        """ Stores {key: value}, one save_key_value rpc per owner node; drops the keys from the client's cache """
+        started = time.perf_counter()
+        dic = {self.hash_key(key): value for key, value in pairs.items()}
+        try:
+            for node_add, group in self.populate.group_by_node(self.existing_port, dic).items():
+                self.populate.deliver(self.existing_port, node_add, group)
+        except Exception:
+            self.requests.record('put', time.perf_counter() - started, 0, len(pairs), True)
+            raise
+        finally:
+            if self.query.cache is not None:
+                self.query.cache.invalidate(dic)
+        self.requests.record('put', time.perf_counter() - started, 0, len(pairs))
+
+    def get_blob(self, key, out):
+        """ Writes the value of key to the binary file out piece by piece, returns its size or None """
+        return self.query.get_blob(self.existing_port, self.hash_key(key), out)
+
+    def put_blob(self, key, source, size):
+        """ Stores size bytes of the binary file source as the value of key, returns the node which stored it """
+        if self.query.cache is not None:
+            self.query.cache.invalidate([self.hash_key(key)])
+        return self.populate.put_blob(self.existing_port, self.hash_key(key), source, size)
+
+    def stats(self):
+        """ Request counts and latencies, the cached ring, open connections and the value cache """
+        requests = {}
+        for command, entry in self.requests.to_dict()['methods'].items():
+            requests[command] = dict(self.histogram.from_dict(entry['latency']).summary(),
+                                     calls=entry['calls'], errors=entry['errors'], keys=entry['bytes_out'])
+        return {
+            'requests': requests,
+            'nodes': self.query.ring.nodes,
+            'idle_connections': self.pool.idle_count(),
+            'cache': self.query.cache.stats() if self.query.cache is not None else None,
+        }
+
+    def close(self):
+        self.query.close()
+
+
+'''
+    Runs one command line against the client
+    get K [K ...] | put K VALUE (the rest of the line) | refresh | stats | ping
+    keys are separated by whitespace, so a key with spaces in it can only be read through the class
+    @:return: reply dict, {'error': message} if the command failed'''
+def run_command(client, line):
+    words = line.split(None, 2)
+    if not words:
+        return {'error': 'empty command'}
+    command = words[0]
+    try:
+        if command == 'get' and len(words) > 1:
+            keys = line.split()[1:]
+            found = client.get_many(keys)
+            return {key: found.get(key) for key in keys}
+        if command == 'put' and len(words) == 3:
+            client.put(words[1], words[2].rstrip('\n'))
+            return {'stored': 1}
+        if command == 'refresh':
+            return {'nodes': client.refresh()}
+        if command == 'stats':
+            return client.stats()
+        if command == 'ping':
+            return {'pong': True}
+    except Exception as e:
+        return {'error': '{}: {}'.format(type(e).__name__, e)}
+    return {'error': 'usage: get K [K ...] | put K VALUE | refresh | stats | ping'}
+
+
+'''
+    json.dumps fallback: values stored as bytes come back as text, undecodable bytes replaced'''
+def to_json(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).decode('utf-8', 'replace')
+    raise TypeError('{} is not JSON serializable'.format(type(value).__name__))
+
+
+def reply_line(reply):
+    return json.dumps(reply, default=to_json) + '\n'
+
+
+'''
+    Default daemon socket for the ring at port: in $XDG_RUNTIME_DIR, else in a directory of its own under /tmp
+    that only this user may enter, which is checked (and with create made) so that another user cannot
+    put a socket of theirs in its place
+    @:return: str'''
+def socket_path(port, create=False):
+    directory = os.environ.get('XDG_RUNTIME_DIR')
+    if not directory:
+        directory = SOCKET_DIR.format(os.getuid())
+        if create:
+            try:
+                os.mkdir(directory, 0o700)
+            except FileExistsError:
+                pass
+        if os.path.lexists(directory):  # if not, no daemon made it and connecting to the socket fails
+            st = os.lstat(directory)
+            if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+                raise PermissionError('{} is not a directory private to this user'.format(directory))
+    return os.path.join(directory, SOCKET_NAME.format(port))
+
+
+'''
+    Clears the way for a daemon to bind path: a socket of ours that no daemon answers on is left
+    over from one that did not shut down cleanly and is removed; anything else is left alone'''
+def remove_stale_socket(path):
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        raise FileExistsError('{} is in the way and is not a socket of this user'.format(path))
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+    raise FileExistsError('a client is already serving {}'.format(path))
+
+
+'''
+    Serves client on a Unix socket: every connection sends command lines and gets one JSON line back for each,
+    connections are handled on their own threads and may stay open for any number of commands
+    the socket is readable and writable by this user only'''
+def serve(client, path):
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                self.wfile.write(reply_line(run_command(client, line.decode())).encode())
+
+    remove_stale_socket(path)
+    umask = os.umask(0o177)  # no window in which the new socket is open to others
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    bound = os.lstat(path)
+    print('serving {} for the ring at port {}'.format(path, client.existing_port), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        try:
+            if os.path.samestat(os.lstat(path), bound):  # not replaced meanwhile
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+'''
+    Reads command lines from stdin and prints one JSON line for each'''
+def repl(client):
+    for line in sys.stdin:
+        if line.strip():
+            sys.stdout.write(reply_line(run_command(client, line)))
+            sys.stdout.flush()
+
+
+'''
+    Thin client: sends one command to a running daemon and returns its reply line
+    @:return: str'''
+def send_command(path, line):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(line.encode() + b'\n')
+        with sock.makefile('rb') as reply:
+            return reply.readline().decode()
+
+
+'''
+    Main method: requires the existing port number
+    --serve : start the client and serve it as a daemon on --socket
+    --repl : start the client and read commands from stdin
+    otherwise the remaining arguments are one command sent to the daemon already serving on --socket:
+    get K [K ...], put K VALUE, refresh, stats or ping; the reply is one line of JSON
+    --socket PATH : daemon socket, chord-client-PORT.sock in $XDG_RUNTIME_DIR by default,
+    or in /tmp/chord-client-UID (mode 0700) if that is not set
+    --lookup, --replicas, --consistency, --cache-size, --cache-ttl : as for chord_query.py,
+    given to --serve and --repl'''
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage='python chord_client.py EXISTINGNODE_PORT (--serve | --repl | COMMAND ...) '
+                                           '[--socket PATH] [--lookup iterative|recursive] [--replicas R] '
+                                           '[--consistency one|quorum|all] [--cache-size N] [--cache-ttl S]')
+    parser.add_argument('existing_node_port', type=int)
+    parser.add_argument('command', nargs='*')
+    parser.add_argument('--serve', action='store_true')
+    parser.add_argument('--repl', action='store_true')
+    parser.add_argument('--socket')
+    # no choices= for these, checked below only when a client is started, so the thin client never imports chord_ring
+    parser.add_argument('--lookup')
+    parser.add_argument('--replicas', type=int, default=1)
+    parser.add_argument('--consistency')
+    parser.add_argument('--cache-size', type=int)
+    parser.add_argument('--cache-ttl', type=float)
+    args = parser.parse_args()
+    if not args.serve and not args.repl:
+        if not args.command or args.command[0] not in COMMANDS:
+            parser.error('give --serve, --repl or one of the commands {}'.format(', '.join(COMMANDS)))
+        try:
+            path = args.socket or socket_path(args.existing_node_port)
+        except PermissionError as e:
+            sys.exit(str(e))
+        try:
+            reply = send_command(path, ' '.join(args.command))
+        except (FileNotFoundError, ConnectionRefusedError):
+            sys.exit('no client is serving {}, start one with --serve'.format(path))
+        sys.stdout.write(reply)
+        sys.exit(1 if list(json.loads(reply)) == ['error'] else 0)
+    from chord_ring import CONSISTENCY_LEVELS, LOOKUP_MODES
+    if args.lookup is not None and args.lookup not in LOOKUP_MODES:
+        parser.error('--lookup must be one of {}'.format(', '.join(LOOKUP_MODES)))
+    if args.consistency is not None and args.consistency not in CONSISTENCY_LEVELS:
+        parser.error('--consistency must be one of {}'.format(', '.join(CONSISTENCY_LEVELS)))
+    if args.serve:
+        try:  # fail before the ring is learnt
+            path = args.socket or socket_path(args.existing_node_port, create=True)
+            remove_stale_socket(path)
+        except OSError as e:
+            sys.exit(str(e))
+    client = ChordClient(args.existing_node_port, args.lookup, args.replicas, args.consistency,
+                         args.cache_size, args.cache_ttl)
+    try:
+        if args.serve:
+            serve(client, path)
+        else:
+            repl(client)
+    finally:
+        client.close()
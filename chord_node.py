@@ -1,23 +1,87 @@
+import argparse
 import hashlib
-import pickle
-import sys
+import itertools
+import os
+import random
+import selectors
 import socket
 import threading
+import time
+import traceback
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from queue import Queue
 
-import rpyc
-from rpyc.utils.server import ThreadedServer
-from threading import Thread
 
+from chord_ring import BLOB_CHUNK, ITERATIVE, ONE, RECURSIVE, hash_key, replicas_needed
+from chord_codec import ERROR, decode_request, encode_reply, encode_reply_parts
+from chord_rpc import DIRECTORY, POOL, RemoteError, recv_frame, send_frame
+from chord_stats import RpcStats, Sampler
+from chord_store import FSYNC_MODES, SNAPSHOT_BYTES, DurableKeyStore, KeyStore, ValueCache
 
 M = 3 # FIXME: Test environment, normally = hashlib.sha1().digest_size * 8
 NODES = 2** M
-BUF_SZ = 4096  # socket recv arg
 BACKLOG = 100  # socket listen arg
 TEST_BASE = 43544  # for testing use port numbers on localhost at TEST_BASE+n
 NUMBER_THREADS = 2
 THREAD_NUMBER = [1, 2]
 QUEUE_OBJ =Queue()
+WORKERS = 16  # default request worker pool size, 0 = one thread per connection
+FORWARDERS = 8  # threads forwarding recursive lookups
+LOOKUP_TIMEOUT = 5  # seconds a recursive lookup waits for its answer before walking iteratively
+MIGRATION_CHUNK = 1000  # keys per chunk when a joining node pulls its range from the successor
+STABILIZE_INTERVAL = 0.5  # seconds between stabilize rounds, 0 = join synchronously with update_others instead
+FIX_FINGERS_INTERVAL = 0.5  # seconds between refreshing one finger table entry
+CHECK_PREDECESSOR_INTERVAL = 1.0  # seconds between checks that the predecessor is still up
+REPLICAS = 1  # copies of every key, on its owner and the owner's next REPLICAS-1 successors
+SUCCESSOR_LIST = 3  # successors a node keeps track of, at least REPLICAS
+VNODES = 1  # ring positions hosted by one process
+CACHE_TTL = 30.0  # seconds a node trusts a cached value without asking its owner, invalidations aside
+PROFILE_STACKS = 20  # profiler stacks the stats rpc returns by default
+UPLOAD_TIMEOUT = 60.0  # seconds an unfinished write_blob upload is kept after its last piece
+
+'''
+    Sets the identifier space to m bits for every node in this process
+    the nodes started from the command line keep the test value, chord_sim uses realistic ones'''
+def set_id_bits(m):
+    global M, NODES
+    M = m
+    NODES = 2 ** m
+
+
+'''
+    Is id in [start, stop) wrapping at NODES, i.e. id in ModRange(start, stop, NODES),
+    worked out with two comparisons instead of building a ModRange and its ranges
+    start == stop is the whole ring, as for ModRange'''
+def in_range(id, start, stop):
+    start %= NODES
+    stop %= NODES
+    if start < stop:
+        return start <= id < stop
+    return id >= start or id < stop
+
+
+'''
+    Is id in the half-open ring interval (a, b]'''
+def in_half_open(id, a, b):
+    return in_range(id, a + 1, b + 1)
+
+
+'''
+    Is id in the open ring interval (a, b)
+    (a, a + 1) is empty, (a, a) is the whole ring but a'''
+def in_open(id, a, b):
+    if (b - a) % NODES == 1:
+        return False
+    return in_range(id, a + 1, b)
+
+
+'''
+    Does the ring interval (start, end] take in all of (new, end], i.e. is new start or inside the interval'''
+def covers(start, new, end):
+    return new == start or in_open(new, start, end)
+
 
 class ModRange(object):
     """
@@ -126,36 +190,271 @@ class FingerEntry(object):
         """ Is the given id within this finger's interval? """
         return id in self.interval
 
+
+
+class FingerTable(object):
+    """
+    Finger table of node n kept as two flat lists instead of one FingerEntry per row.
+
+    start[k] and node[k] are the start and node of row k, indexing starts at 1 as in the paper.
+    The interval of row k is [start[k], start[k + 1]), or [start[M], n) for the last row.
+
+    >>> ft = FingerTable(3)
+    >>> ft.start[1:], ft.next_start(M)
+    ([4, 5, 7], 3)
+    """
+    __slots__ = ('n', 'start', 'node')
+
+    def __init__(self, n):
+        self.n = n
+        self.start = [None] + [(n + 2 ** (k - 1)) % NODES for k in range(1, M + 1)]
+        self.node = [None] * (M + 1)
+
+    def next_start(self, k):
+        return self.start[k + 1] if k < M else self.n
+
+    def entry(self, k):
+        """ Row k as a FingerEntry, for display """
+        return FingerEntry(self.n, k, self.node[k])
+
+
+class WorkerPool(object):
+    """
+    Request workers of serve_pooled: size threads running, plus one for every worker waiting on another node.
+
+    A handler waiting on a nested rpc (find_successor walking the fingers, update_finger_table,
+    replication) says so with blocking(), and while it waits another worker takes its place. So the
+    successor and closest_preceding_finger rpcs other nodes send back while serving it are always
+    answered, where a fixed pool deadlocks once every worker is parked on a nested call.
+    Workers above size exit as soon as they find no work. Threads start on the first submit.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.tasks = deque()
+        self.cond = threading.Condition()
+        self.threads = 0  # workers alive
+        self.idle = 0  # workers waiting for a task
+        self.blocked = 0  # workers waiting on another node
+        self.local = threading.local()  # .worker on pool threads, .blocked while inside blocking()
+
+    def submit(self, fn, *args):
+        with self.cond:
+            self.tasks.append((fn, args))
+            if self.idle:
+                self.cond.notify()
+            elif self.threads - self.blocked < self.size:
+                self.start_worker()
+
+    def start_worker(self):
+        """ Called with cond held """
+        self.threads += 1
+        threading.Thread(target=self.work, daemon=True).start()
+
+    def work(self):
+        self.local.worker = True
+        while True:
+            with self.cond:
+                while not self.tasks:
+                    if self.threads - self.blocked > self.size:
+                        self.threads -= 1
+                        return
+                    self.idle += 1
+                    self.cond.wait()
+                    self.idle -= 1
+                fn, args = self.tasks.popleft()
+            try:
+                fn(*args)
+            except Exception:
+                traceback.print_exc()
+
+    @contextmanager
+    def blocking(self):
+        """ Marks the calling worker as waiting on another node for the duration, a no-op off the pool """
+        local = self.local
+        if not getattr(local, 'worker', False) or getattr(local, 'blocked', False):
+            yield
+            return
+        local.blocked = True
+        with self.cond:
+            self.blocked += 1
+            if self.tasks and not self.idle and self.threads - self.blocked < self.size:
+                self.start_worker()
+        try:
+            yield
+        finally:
+            local.blocked = False
+            with self.cond:
+                self.blocked -= 1
+                if self.idle and self.threads - self.blocked > self.size:
+                    self.cond.notify()  # an idle stand-in is surplus again, let it exit
+
     '''
     Chord class which implements chord paper
     '''
 
 
 class ChordNode:
-    def __init__(self, n):
+    def __init__(self, n, workers=WORKERS, store=None, migration_chunk=MIGRATION_CHUNK,
+                 stabilize_interval=STABILIZE_INTERVAL, fix_fingers_interval=FIX_FINGERS_INTERVAL,
+                 check_predecessor_interval=CHECK_PREDECESSOR_INTERVAL, replicas=REPLICAS, host=None,
+                 cache_size=0, cache_ttl=CACHE_TTL, transport=POOL, profile_interval=0):
         self.node = n
-        self.finger = [None] + [FingerEntry(n, k) for k in range(1, M + 1)]  # indexing starts at 1
+        self.finger = FingerTable(n)
         self.predecessor = None
-        self.keys = {}
+        if host is None:
+            self.keys = store if store is not None else KeyStore()
+            self.lock = threading.RLock()  # guards finger, predecessor and keys; never held across a call_rpc
+            self.forwarder = ThreadPoolExecutor(FORWARDERS)
+            self.worker_pool = WorkerPool(workers)  # serve_pooled's workers, started on the first request
+            self.vnodes = {n: self}  # every ring position this process hosts, by node id
+            self.port = TEST_BASE + n
+            self.versions = {}  # key -> version, a new one on every write, so cached copies can be checked
+            self.version_ids = itertools.count(time.time_ns())  # keeps increasing across restarts
+            self.cachers = {}  # key -> ids of nodes caching it, told by invalidate when it is overwritten
+            self.replica_ranges = {}  # owner id -> start, copies of (start, owner] are kept here for it, see replica_range
+            self.uploads = {}  # write_blob upload id -> [key, BlobBuffer, time of its last piece]
+            self.cache = ValueCache(cache_size, cache_ttl) if cache_size > 0 else None  # read_through cache
+            self.transport = transport  # anything with call_node and discard_node, see call_rpc
+            self.stats = RpcStats()  # rpcs served, connections and lookup hops of the whole process
+            self.sampler = Sampler(profile_interval).start() if profile_interval > 0 else None
+        else:
+            # a virtual node shares storage, lock, threads and server socket with the node hosting it
+            self.keys = host.keys
+            self.lock = host.lock
+            self.forwarder = host.forwarder
+            self.worker_pool = host.worker_pool
+            self.vnodes = host.vnodes
+            self.port = host.port
+            self.versions = host.versions
+            self.version_ids = host.version_ids
+            self.cachers = host.cachers
+            self.replica_ranges = host.replica_ranges
+            self.uploads = host.uploads
+            self.cache = host.cache
+            self.transport = host.transport
+            self.stats = host.stats
+            self.sampler = host.sampler
+            self.vnodes[n] = self
+            DIRECTORY[n] = host.port
         self.hash = {}
+        self.workers = workers
+        self.migration_chunk = migration_chunk
+        self.schedule = [(self.stabilize, stabilize_interval),
+                         (self.fix_fingers, fix_fingers_interval),
+                         (self.check_predecessor, check_predecessor_interval)]
+        self.next_finger = 1  # finger table entry fix_fingers refreshes next
+        self.replicas = replicas
+        self.successor_list = []  # the next max(replicas, SUCCESSOR_LIST) nodes round the ring, kept by stabilize
+        self.replica_state = None  # (predecessor, replica targets) as of the last repair_replicas, None to redo it
+        self.handoff = None  # (start, end, keys written meanwhile) while a joining predecessor copies a range from us
+        self.incoming = None  # (source, start, end, keys written meanwhile) while we copy our range from the successor
+        self.lookups = {}  # recursive lookup id -> [Event, answer]
+        self.lookup_ids = itertools.count()
+        # rpc name -> handler, every name also needs an opcode in chord_codec.METHODS
+        self.rpc_handlers = {
+            'find_successor': self.find_successor,
+            'find_successors': self.find_successors,
+            'predecessor': lambda: self.predecessor,
+            'update_predecessor': self.update_predecessor,
+            'successor': lambda: self.successor,
+            'update_finger_table': self.update_finger_table,
+            'closest_preceding_finger': self.closest_preceding_finger,
+            'save_key_value': self.save_key_value,
+            'retrieve_value': self.retrieve_value,
+            'retrieve_values': self.retrieve_values,
+            'generate_keys': self.generate_keys,
+            'forward_lookup': self.forward_lookup,
+            'lookup_reply': self.lookup_reply,
+            'migrate_keys': self.migrate_keys,
+            'finish_migration': self.finish_migration,
+            'notify': self.notify,
+            'successor_list': self.successors,
+            'replicate': self.replicate,
+            'at': self.dispatch_at,
+            'directory': lambda: dict(DIRECTORY),
+            'host_info': self.host_info,
+            'read_versions': self.read_versions,
+            'read_through': self.read_through,
+            'invalidate': self.invalidate,
+            'stats': self.report_stats,
+            'write_blob': self.write_blob,
+            'read_blob': self.read_blob,
+            'replica_range': self.replica_range,
+        }
+
+    '''
+        Adds a virtual node with id n to this process, it joins the ring through join_all
+        @:return: the new ChordNode'''
+    def add_vnode(self, n):
+        return ChordNode(n, self.workers, None, self.migration_chunk,
+                         *[interval for task, interval in self.schedule], replicas=self.replicas, host=self)
+
+    '''
+        Joins this node and then every virtual node of the process,
+        after learning the virtual node ports the existing node knows of,
+        and starts their maintain threads when stabilization is on
+        a virtual node whose id is taken already is dropped before anything joins, as it would
+        otherwise shadow the node that has it
+        Param 1: port number of existing node in the chord, 0 for a new ring'''
+    def join_all(self, existing_node_address):
+        vnodes = [v for v in self.vnodes.values() if v is not self]
+        if existing_node_address:
+            DIRECTORY.merge(POOL.call(existing_node_address, 'directory'), self.vnodes)
+            for vnode in list(vnodes):
+                if POOL.call(existing_node_address, 'find_successor', vnode.node) == vnode.node:
+                    print('node id {} is taken, virtual node dropped'.format(vnode.node))
+                    vnodes.remove(vnode)
+                    with self.lock:
+                        del self.vnodes[vnode.node]
+                    DIRECTORY.pop(vnode.node, None)
+        self.join_network(existing_node_address, self.node)
+        entry = existing_node_address or self.port
+        for vnode in vnodes:
+            vnode.join_network(entry, vnode.node)
+        if self.schedule[0][1] > 0:
+            for vnode in [self] + vnodes:
+                threading.Thread(target=vnode.maintain, daemon=True).start()
 
     ''' 
         This method, Joins a network if  existing_node_address != 0 and initialise its finger table
-        Update others
+        With stabilization on (stabilize_interval > 0) it only learns its successor, takes over its keys
+        and leaves the rest to maintain (started by join_all): the predecessor finds out about this node on its
+        next stabilize and the fingers converge one fix_fingers round at a time
+        Otherwise it fills every finger and runs update_others before returning
         if this is the very first node in the chord it put itself in the finger table and predecessor as well '''
     def join_network(self, existing_node_address, n):
+        stabilizing = self.schedule[0][1] > 0
         if not existing_node_address == 0:
             existing_node = existing_node_address - TEST_BASE
-            self.init_finger_table(existing_node)
-            self.update_others()
-            for i in range(1, M + 1):
-                self.update_finger_table(self.node, i)
+            if stabilizing:
+                self.join_successor(existing_node)
+            else:
+                self.init_finger_table(existing_node)
+                self.update_others()
+                for i in range(1, M + 1):
+                    self.update_finger_table(self.node, i)
         else:
-            for i in range(1, M + 1):
-                self.finger[i].node = n
-            self.predecessor = n
+            with self.lock:
+                for i in range(1, M + 1):
+                    self.finger.node[i] = n
+                self.predecessor = n
            #self.print_finger_table()
 
+    '''
+        Joins through existing_node with one find_successor lookup
+        every finger starts out as the successor, which is always a safe (if slow) way round the ring
+        Param 1: node number of existing node in the chord network'''
+    def join_successor(self, existing_node):
+        successor = self.call_rpc(existing_node, 'find_successor', self.node)
+        with self.lock:
+            for i in range(1, M + 1):
+                self.finger.node[i] = successor
+        self.predecessor = np = self.call_rpc(successor, 'predecessor')
+        if np is None:  # the successor lost its predecessor, so it may hold anything outside (self.node, successor]
+            np = successor
+        self.pull_keys(successor, np + 1, self.node + 1)
+
     '''
         This method initialize the finger table
         Param 1: node number of existing node in the chord network
@@ -163,31 +462,95 @@ class ChordNode:
         update its predecessor, and call rpc to its successor to update self.node as its predecessor
         Updates keys whenever there is new node in the chord network'''
     def init_finger_table(self, existing_node):
-        self.finger[1].node = self.call_rpc(existing_node, 'find_successor', self.finger[1].start)
+        self.finger.node[1] = self.call_rpc(existing_node, 'find_successor', self.finger.start[1])
         self.predecessor = self.call_rpc(self.successor, 'predecessor')
-        self.call_rpc(self.successor, 'update_predecessor', self.node)
-        keys_to_save = self.call_rpc(self.successor, 'generate_keys', self.predecessor+1, self.node+1)
-        self.keys.update(keys_to_save)
+        self.pull_keys(self.successor, self.predecessor + 1, self.node + 1)
         for i in range(1, M):
-            if self.finger[i + 1].start in ModRange(self.node, self.finger[i].node, NODES):
-                self.finger[i + 1].node = self.finger[i].node
+            if in_range(self.finger.start[i + 1], self.node, self.finger.node[i]):
+                self.finger.node[i + 1] = self.finger.node[i]
             else:
-                self.finger[i + 1].node = self.call_rpc(existing_node, 'find_successor', self.finger[i + 1].start)
+                node = self.call_rpc(existing_node, 'find_successor', self.finger.start[i + 1])
+                self.finger.node[i + 1] = node
         #self.print_finger_table()
 
     '''
         This method updates the keys whenever new node is being added to the chord network
         Param 1 and Param 2: (predecessor+1, self+node)
         This method asks its successor to provide the keys for which, it is responsible for
-        keys between range (predecessor+1, self+node) should be return as a response
+        keys between range (predecessor+1, self+node) should be return as a response,
+        the range wraps around 0 like ModRange and is cut out of the sorted key index,
+        so the cost follows the number of keys moved rather than the size of the range
         @:return: {key: value} pairs'''
     def generate_keys(self, start, end):
-        response = {}
-        for key in range(start, end):
-            if key in self.keys:
-                response.update({key:self.keys[key]})
-        for key_ in response:
-            if key_ in self.keys: del self.keys[key_]
+        with self.lock:
+            moved = self.keys.pop_range(start, end, NODES)
+        self.keys.sync()
+        return moved
+
+    '''
+        Copies the keys in [start, end) from the successor, migration_chunk keys per rpc
+        the successor keeps owning and serving the range while it is copied; each request for
+        the next chunk acknowledges the previous one, and only once every chunk has arrived does
+        finish_migration make this node the owner, drop the range on the successor and hand
+        back whatever was written there in the meantime
+        reads that reach this node for keys not copied yet are answered from the successor
+        Param 1: successor node number
+        Param 2 and Param 3: (predecessor+1, self.node+1)'''
+    def pull_keys(self, source, start, end):
+        if source in self.vnodes:  # same process, the keys are in the shared store already
+            self.call_rpc(source, 'finish_migration', start, end, self.node)
+            return
+        with self.lock:
+            self.incoming = (source, start, end, set())
+        moved = 0
+        cursor = start
+        while cursor is not None:
+            chunk, cursor = self.call_rpc(source, 'migrate_keys', start, end, cursor, self.migration_chunk)
+            moved += self.store_migrated(chunk)
+            print('migrating keys from node {}: {} received'.format(source, moved))
+        written = self.call_rpc(source, 'finish_migration', start, end, self.node, self.local_directory())
+        moved += self.store_migrated(written.items())
+        with self.lock:
+            self.incoming = None
+        print('migrated {} keys from node {}'.format(moved, source))
+
+    '''
+        Stores migrated pairs, except for keys written to this node since the migration began
+        @:return: number of pairs stored'''
+    def store_migrated(self, pairs):
+        with self.lock:
+            written = self.incoming[3]
+            pairs = {key: value for key, value in pairs if key not in written}
+            self.keys.update(pairs)
+        self.keys.sync()
+        return len(pairs)
+
+    '''
+        Serves one chunk of a joining predecessor's migration, see pull_keys
+        the first chunk (cursor == start) starts tracking writes to the range
+        Param 1 and Param 2: the range being migrated, [start, end)
+        Param 3: where this chunk starts, Param 4: max keys in the chunk
+        @:return: ([(key, value), ...], where the next chunk starts or None after the last one)'''
+    def migrate_keys(self, start, end, cursor, limit):
+        with self.lock:
+            if cursor == start:
+                self.handoff = (start, end, set())
+            return self.keys.range_chunk(cursor, end, NODES, limit)
+
+    '''
+        Ends a migration: node becomes our predecessor and owner of [start, end), the range is
+        dropped here and the keys written to it while it was being copied are returned
+        @:return: {key: value} written during the migration'''
+    def finish_migration(self, start, end, node, directory=None):
+        DIRECTORY.merge(directory, self.vnodes)
+        with self.lock:
+            written = self.handoff[2] if self.handoff else ()
+            response = {key: self.keys[key] for key in written if key in self.keys}
+            self.predecessor = node
+            if self.replicas == 1 and node not in self.vnodes:  # otherwise this node stays one of the range's replicas, or shares the store
+                self.keys.delete_range(start, end, NODES)
+            self.handoff = None
+        self.keys.sync()
         return response
     '''
         This method iterates all the nodes for which finger table should be updated
@@ -199,6 +562,107 @@ class ChordNode:
             self.call_rpc(np, 'update_finger_table', self.node, i)
         #self.print_finger_table()
 
+    '''
+        Runs stabilize, fix_fingers and check_predecessor forever, each on its own interval
+        a task with interval 0 is not run; a failed round is reported and retried next time,
+        whatever it failed with, so one bad reply never stops the node's maintenance for good'''
+    def maintain(self):
+        tasks = [(task, interval) for task, interval in self.schedule if interval > 0]
+        due = [time.monotonic()] * len(tasks)
+        while True:
+            i = min(range(len(tasks)), key=due.__getitem__)
+            time.sleep(max(0, due[i] - time.monotonic()))
+            task, interval = tasks[i]
+            try:
+                task()
+            except (OSError, RemoteError) as e:  # a peer gone or failing, expected while the ring churns
+                print('{} failed: {}'.format(task.__name__, e))
+            except Exception:
+                print('{} failed:'.format(task.__name__))
+                traceback.print_exc()
+            due[i] = time.monotonic() + interval
+
+    '''
+        Verifies the successor and tells it about this node
+        if the successor has learnt of a node between the two of us, that node becomes the successor
+        with replication on, the new successor list is then checked by repair_replicas'''
+    def stabilize(self):
+        successor = self.successor
+        try:
+            x = self.call_rpc(successor, 'predecessor')
+        except OSError:
+            self.drop_successor(successor)
+            raise
+        if x is not None and in_open(x, self.node, successor):
+            with self.lock:
+                self.successor = successor = x
+        DIRECTORY.merge(self.call_rpc(successor, 'notify', self.node, self.local_directory()), self.vnodes)
+        successors = [successor] + self.call_rpc(successor, 'successor_list')
+        if self.node in successors:  # the ring is shorter than the list
+            successors = successors[:successors.index(self.node)]
+        with self.lock:
+            self.successor_list = successors[:max(self.replicas, SUCCESSOR_LIST)]
+        if self.replicas > 1:
+            self.repair_replicas()
+
+    '''
+        The successor stopped answering: the next live entry of the successor list takes its place
+        with nothing left in the list the node falls back on itself until someone notifies it
+        Param 1: node number of the failed successor'''
+    def drop_successor(self, failed):
+        self.transport.discard_node(failed)
+        with self.lock:
+            self.successor_list = [n for n in self.successor_list if n != failed]
+            if self.successor == failed:
+                self.successor = self.successor_list[0] if self.successor_list else self.node
+
+    '''
+        @:return: [successor, its successor, ...] as far as this node knows them'''
+    def successors(self):
+        with self.lock:
+            return list(self.successor_list) or [self.successor]
+
+    '''
+        n thinks it might be our predecessor
+        the two nodes swap the virtual node ports they know of on the way, so every node learns them
+        Param 1: node number
+        Param 2: {node id: port} known to n
+        @:return: {node id: port} known here'''
+    def notify(self, n, directory=None):
+        DIRECTORY.merge(directory, self.vnodes)
+        with self.lock:
+            if self.predecessor is None or in_open(n, self.predecessor, self.node):
+                self.predecessor = n
+        return self.local_directory()
+
+    '''
+        @:return: {node id: port} of every virtual node this process knows of'''
+    def local_directory(self):
+        return dict(DIRECTORY)
+
+    '''
+        Refreshes one finger table entry per call, going round entries 1..M'''
+    def fix_fingers(self):
+        i = self.next_finger
+        self.next_finger = i % M + 1
+        node = self.find_successor(self.finger.start[i])
+        with self.lock:
+            self.finger.node[i] = node
+
+    '''
+        Forgets the predecessor once it stops answering, so a live node can take its place through notify'''
+    def check_predecessor(self):
+        np = self.predecessor
+        if np is None or np == self.node:
+            return
+        try:
+            self.call_rpc(np, 'successor')
+        except OSError:
+            self.transport.discard_node(np)
+            with self.lock:
+                if self.predecessor == np:
+                    self.predecessor = None
+
     '''
         This method updates finger table
         Param 1: Node number
@@ -206,10 +670,13 @@ class ChordNode:
         @:return: string(self)
         '''
     def update_finger_table(self, s, i):
-        if self.finger[i].start != self.finger[i].node and s in ModRange(self.finger[i].start, self.finger[i].node, NODES):
-            self.finger[i].node = s
-            #self.print_finger_table()
+        with self.lock:
+            updated = self.finger.start[i] != self.finger.node[i] and in_range(s, self.finger.start[i], self.finger.node[i])
+            if updated:
+                self.finger.node[i] = s
             np = self.predecessor
+        if updated:
+            #self.print_finger_table()
             if np != s:
                 self.call_rpc(np, 'update_finger_table', s, i)
             return str(self)
@@ -219,9 +686,10 @@ class ChordNode:
         To print finger table'''
     def print_finger_table(self):
         print('##############################################################################')
-        for i in range(1, M + 1):
-            print("finger table entry :", self.finger[i].start, self.finger[i].next_start, self.finger[i].node)
-        print('The keys are :', self.keys)
+        with self.lock:
+            for i in range(1, M + 1):
+                print("finger table entry :", self.finger.start[i], self.finger.next_start(i), self.finger.node[i])
+            print('The keys are :', self.keys)
         print('##############################################################################')
 
     '''
@@ -231,8 +699,8 @@ class ChordNode:
         '''
     @property
     def successor(self):
-        #print('successor is :', self.finger[1].node)
-        return self.finger[1].node
+        #print('successor is :', self.finger.node[1])
+        return self.finger.node[1]
 
     '''
         This method updates the successor 
@@ -240,7 +708,7 @@ class ChordNode:
         '''
     @successor.setter
     def successor(self, id):
-        self.finger[1].node = id
+        self.finger.node[1] = id
 
     '''
         This method updates the predecessor 
@@ -252,56 +720,508 @@ class ChordNode:
     '''
         This method is used to find the successor of node, Id passed in the parameter
         Param 1: node number for which we want to get the successor
+        Param 2: ITERATIVE walks the ring from here, RECURSIVE forwards the lookup (find_successor_recursive)
         @:return: node number'''
-    def find_successor(self, id):
+    def find_successor(self, id, mode=ITERATIVE):
+        if mode == RECURSIVE:
+            return self.find_successor_recursive(id)
         np = self.find_predecessor(id)
         return self.call_rpc(np, 'successor')
+
+    '''
+        Batched find_successor, used by bulk loading to resolve many keys in one rpc
+        Param 1: list of ids
+        Param 2: lookup mode, as for find_successor
+        @:return: list of node numbers, in the same order'''
+    def find_successors(self, ids, mode=ITERATIVE):
+        owners = {}
+        for id in ids:
+            if id not in owners:
+                owners[id] = self.find_successor(id, mode)
+        return [owners[id] for id in ids]
+
+    '''
+        Recursive lookup: instead of two rpcs per hop that all come back here,
+        the lookup is passed on with one forward_lookup per hop and the node preceding id
+        sends the answer straight back with lookup_reply
+        Falls back to the iterative walk if no answer arrives within LOOKUP_TIMEOUT
+        Param 1: id
+        @:return: node number'''
+    def find_successor_recursive(self, id):
+        request_id = next(self.lookup_ids)
+        waiter = [threading.Event(), None]
+        self.lookups[request_id] = waiter
+        try:
+            self.forward_lookup(id, self.node, request_id)
+            with self.worker_pool.blocking():  # the lookup_reply that ends the wait needs a worker too
+                if waiter[0].wait(LOOKUP_TIMEOUT):
+                    return waiter[1]
+        finally:
+            del self.lookups[request_id]
+        return self.find_successor(id)
+
+    '''
+        Receives a forwarded lookup and acknowledges it at once
+        the routing itself runs on the forwarder pool, so no server worker waits on the next hop
+        Param 1, Param 2 and Param 3: id, originating node number, lookup id'''
+    def forward_lookup(self, id, origin, request_id):
+        self.forwarder.submit(self.route_lookup, id, origin, request_id)
+
+    '''
+        One hop of a recursive lookup
+        If id is between this node and its successor the successor is the answer and goes to the origin,
+        otherwise the lookup moves on to the closest preceding finger (or the successor, if no finger is closer)'''
+    def route_lookup(self, id, origin, request_id):
+        succ = self.successor
+        try:
+            if in_half_open(id, self.node, succ):
+                self.call_rpc(origin, 'lookup_reply', request_id, succ)
+            else:
+                np = self.closest_preceding_finger(id)
+                self.call_rpc(succ if np == self.node else np, 'forward_lookup', id, origin, request_id)
+        except OSError:
+            traceback.print_exc()  # the origin times out and walks iteratively
+
+    '''
+        Answer to a recursive lookup this node started
+        Param 1 and Param 2: lookup id, node number'''
+    def lookup_reply(self, request_id, node):
+        waiter = self.lookups.get(request_id)
+        if waiter is not None:
+            waiter[1] = node
+            waiter[0].set()
     '''
         This method is used to find the predecessor of node Id passed in the parameter
+        A hop that does not answer is routed around: the walk backs up to the node that named it
+        and asks that node again, leaving out every node found down so far
         Param 1: node number for which we want to get the predecessor
         @:return: node number'''
     def find_predecessor(self, id):
         np = self.node
-        while id not in ModRange(np + 1, self.call_rpc(np, 'successor') + 1, NODES): #TODO
-            np = self.call_rpc(np, 'closest_preceding_finger', id)
+        path = []  # nodes the walk has passed through, to back up to
+        down = []  # nodes that did not answer during this walk
+        hops = 0
+        while True:
+            try:
+                if in_half_open(id, np, self.call_rpc(np, 'successor')): #TODO
+                    break
+                if down:
+                    nxt = self.call_rpc(np, 'closest_preceding_finger', id, down)
+                else:
+                    nxt = self.call_rpc(np, 'closest_preceding_finger', id)
+            except OSError:
+                if not path:
+                    raise
+                down.append(np)
+                np = path.pop()
+                continue
+            if nxt == np:
+                break  # every node between np and id is down, so np precedes id among the live ones
+            path.append(np)
+            np = nxt
+            hops += 1
+        self.stats.hop(hops)
         return np
 
     '''
         This method is used to the closest finger table entry for id
          Param 1: node number for which we want the closest node in finger table
+         Param 2: nodes to leave out, known to be down; the successor list stands in for skipped fingers
          @:return: node number'''
-    def closest_preceding_finger(self, id):
+    def closest_preceding_finger(self, id, down=()):
         n = self.node
+        nodes = self.finger.node
         for i in range(M, 0, -1):
-            if self.finger[i].node in ModRange(n+1, id, NODES):
-                return self.finger[i].node
+            node = nodes[i]
+            if in_open(node, n, id) and node not in down:
+                return node
+        if down:
+            for node in reversed(self.successor_list):
+                if in_open(node, n, id) and node not in down:
+                    return node
         return n
     '''
         This method is used is update the self.keys dictionary object
         which populate class request to save on the node
-        Param 1: {key : value } pair which populate has send to save
-        @:return: None'''
-    def save_key_value(self, key_val):
-        dic = pickle.loads(key_val)
+        keys outside (predecessor, self.node] are not saved but handed back, which tells
+        a client with a stale view of the ring to look the owner up again
+        the saved keys are copied to the next replicas-1 successors; the call returns once as many
+        copies as the consistency level asks for are stored, the rest finish in the background
+        Param 1: {key : value } pairs which populate has send to save
+        Param 2: write consistency, one / quorum / all
+        @:return: {key : value } pairs this node is not responsible for'''
+    def save_key_value(self, dic, consistency=ONE):
+        with self.lock:
+            rejected = {key: dic.pop(key) for key in list(dic) if not self.is_responsible(key)}
+            stale = self.update_keys(dic)
+        self.settle_keys(stale)  # fsync outside the lock, so concurrent writes share it
+        if self.replicas > 1 and dic:
+            self.replicate_to_successors(replicas_needed(consistency, self.replicas) - 1,
+                                         lambda n: self.call_rpc(n, 'replicate', dic))
+        return rejected
+
+    '''
+        The nodes holding copies of this node's keys: its first replicas-1 successors in other
+        processes, as virtual nodes of one process share a store
+        @:return: [node number, ...]'''
+    def replica_targets(self):
+        targets = []
+        ports = {self.port}
+        for n in self.successors():
+            port = self.port if n in self.vnodes else DIRECTORY.port(n)
+            if port not in ports:
+                ports.add(port)
+                targets.append(n)
+        return targets[:self.replicas - 1]
+
+    '''
+        Copies keys to the replica successors with send(node) on the forwarder threads and waits
+        until needed of them have them, returns at once if needed is 0 (consistency one)
+        a copy that fails is made good by the next repair_replicas
+        raises RuntimeError if too many of them fail'''
+    def replicate_to_successors(self, needed, send):
+        targets = self.replica_targets()
+        needed = min(needed, len(targets))
+        futures = [self.forwarder.submit(self.send_copy, send, n) for n in targets]
+        if not needed:
+            return
+        stored = failed = 0
+        with self.worker_pool.blocking():
+            for future in as_completed(futures):
+                if future.exception() is None:
+                    stored += 1
+                else:
+                    failed += 1
+                if stored >= needed:
+                    return
+        raise RuntimeError('{} of {} replicas stored the keys, {} needed'.format(stored, len(targets), needed))
+
+    def send_copy(self, send, n):
+        try:
+            send(n)
+        except Exception:
+            self.replica_state = None  # the next repair_replicas copies every key again
+            raise
+
+    '''
+        Re-replication, run after every stabilize: tells each replica successor that it keeps copies of
+        (predecessor, self.node] with replica_range, and copies the keys of that range to the successors
+        that may lack some, migration_chunk keys per replicate rpc: a new successor, any successor once
+        the range has grown or a copy could not be sent, and one that has lost the range meanwhile
+        (e.g. restarted); a successor dropped from the list is told to let the range go
+        a pass that fails is tried again after the next stabilize'''
+    def repair_replicas(self):
+        with self.lock:
+            start = self.predecessor
+        if start is None:
+            return
+        targets = self.replica_targets()
+        done = self.replica_state
+        for n in targets:
+            had = self.call_rpc(n, 'replica_range', self.node, start)
+            if (done is not None and n in done[1] and covers(done[0], start, self.node)
+                    and had is not None and covers(had, start, self.node)):
+                continue
+            cursor = start + 1
+            while cursor is not None:
+                with self.lock:
+                    chunk, cursor = self.keys.range_chunk(cursor, self.node + 1, NODES, self.migration_chunk)
+                if chunk:
+                    self.call_rpc(n, 'replicate', dict(chunk))
+            print('replicated keys ({}, {}] to node {}'.format(start, self.node, n))
+        for n in done[1] if done is not None else ():
+            if n not in targets:
+                try:
+                    self.call_rpc(n, 'replica_range', self.node, None)
+                except OSError:
+                    pass  # gone, nothing to let go of
+        self.replica_state = (start, targets)
+
+    '''
+        An owner tells this process which of its keys to keep copies of, see repair_replicas:
+        (start, owner], or none if start is None; copies in a range that shrank or was let go are
+        deleted unless the process keeps them for another reason (holds)
+        an owner that lies inside the new range cannot be alive any more, so its range goes too
+        Param 1 and Param 2: owner node number, start of its range
+        @:return: the start this process had for owner before, None if it had none'''
+    def replica_range(self, owner, start):
+        with self.lock:
+            ranges = self.replica_ranges
+            had = ranges.pop(owner, None)
+            released = []
+            if had is not None and (start is None or in_open(start, had, owner)):
+                released.append((had, owner if start is None else start))
+            if start is not None:
+                for other in [o for o in ranges if in_open(o, start, owner)]:
+                    released.append((ranges.pop(other), other))
+                ranges[owner] = start
+            stale = [key for lo, hi in released for key in self.keys.range_keys(lo + 1, hi + 1, NODES)
+                     if not self.holds(key)]
+            self.keys.delete(stale)
+        self.keys.sync()
+        return had
+
+    '''
+        Does this process keep key: one of its nodes owns it, or it is in a range an owner has
+        given it copies of; other copies are left over from a range that moved, and are not served
+        the caller holds the lock'''
+    def holds(self, key):
+        if self.is_responsible(key):
+            return True
+        for vnode in self.vnodes.values():
+            if vnode.predecessor is not None and in_half_open(key, vnode.predecessor, vnode.node):
+                return True
+        return any(in_half_open(key, start, owner) for owner, start in self.replica_ranges.items())
+
+    '''
+        One piece of a large value, streamed in order in pieces of up to BLOB_CHUNK bytes so that no
+        message and no buffer on the way has to hold all of it; the node collects the pieces in
+        a BlobBuffer of its store (in memory, or a staging file for a durable store) and stores
+        the value once the last one is in, then streams it on to the replicas the same way
+        Param 1 and Param 2: key, upload id chosen by the sender, the same for every piece
+        Param 3 and Param 4: offset of the piece in the value, the piece
+        Param 5: size of the whole value
+        Param 6: write consistency, one / quorum / all, applies when the last piece is in
+        Param 7: True for copies sent by the key's owner, which skip the ownership check
+        @:return: False if the first piece reaches a node not responsible for key, else True'''
+    def write_blob(self, key, upload, offset, piece, size, consistency=ONE, replica=False):
+        now = time.monotonic()
+        with self.lock:
+            if offset == 0:
+                if not replica and not self.is_responsible(key):
+                    return False
+                for stale in [u for u, entry in self.uploads.items() if now - entry[2] > UPLOAD_TIMEOUT]:
+                    self.uploads.pop(stale)[1].discard()
+                self.uploads[upload] = [key, self.keys.blob_writer(key, size), now]
+            entry = self.uploads[upload]
+            entry[2] = now
+        blob = entry[1]
+        try:
+            blob.write(offset, piece)
+        except Exception:
+            with self.lock:
+                self.uploads.pop(upload, None)
+            blob.discard()
+            raise
+        if not blob.complete:
+            return True
+        with self.lock:
+            del self.uploads[upload]
+        self.store_keys({key: blob.value()})
+        if self.replicas > 1 and not replica:
+            self.replicate_to_successors(replicas_needed(consistency, self.replicas) - 1,
+                                         lambda n: self.stream_blob(n, key))
+        return True
+
+    '''
+        Sends the value of key to node n with write_blob, one BLOB_CHUNK piece at a time
+        gives up quietly if key is overwritten meanwhile, the new value is replicated by its own write'''
+    def stream_blob(self, n, key):
+        upload = random.getrandbits(63)
+        offset = 0
+        size = version = None
+        while size is None or offset < size:
+            with self.lock:
+                current = self.keys.value_range(key, offset, BLOB_CHUNK)
+                if current is None or (size is not None and self.versions.get(key) != version):
+                    return
+                version = self.versions.get(key)
+            size, piece = current
+            self.call_rpc(n, 'write_blob', key, upload, offset, piece, size, ONE, True)
+            offset += len(piece)
+
+    '''
+        One piece of a value, for reading large values in pieces of bounded size
+        pieces of bytes values are sent without being copied; str values are read as utf-8
+        Param 1, Param 2 and Param 3: key, offset, most bytes to return
+        @:return: (size of the whole value, its version, piece), the version changes when the value
+                  is overwritten; None if the key is not stored here, False if this node is not responsible for it'''
+    def read_blob(self, key, offset, length):
+        with self.lock:
+            current = self.keys.value_range(key, offset, min(length, BLOB_CHUNK)) if self.holds(key) else None
+            if current is None:
+                return None if self.is_responsible(key) else False
+            return current[0], self.versions.get(key), current[1]
+
+    '''
+        Stores copies of keys owned by a predecessor, without the ownership check of save_key_value
+        Param 1: {key : value }'''
+    def replicate(self, dic):
+        self.store_keys(dic)
+
+    def store_keys(self, dic):
+        with self.lock:
+            stale = self.update_keys(dic)
+        self.settle_keys(stale)
+
+    '''
+        The part of store_keys made under the node lock, which the caller holds: stores dic, gives
+        the keys new versions and notes them for a migration in progress
+        @:return: {cacher node: [keys it has to drop]}, for settle_keys'''
+    def update_keys(self, dic):
+        stale = {}
         self.keys.update(dic)
-        #return None this is the change
+        for key in dic:
+            self.versions[key] = next(self.version_ids)
+            for cacher in self.cachers.pop(key, ()):
+                stale.setdefault(cacher, []).append(key)
+        for moving in (self.handoff, self.incoming):
+            if moving:
+                moving[-1].update(key for key in dic if in_range(key, moving[-3], moving[-2]))
+        return stale
+
+    '''
+        The part of store_keys made once the node lock is free: the disk wait, if any,
+        and the invalidations for the nodes caching overwritten keys'''
+    def settle_keys(self, stale):
+        self.keys.sync()
+        for cacher, keys in stale.items():
+            self.forwarder.submit(self.send_invalidate, cacher, keys)
+
+    '''
+        Tells a node caching keys that they were overwritten, a node that cannot be reached
+        is left to expire its copies by ttl'''
+    def send_invalidate(self, cacher, keys):
+        try:
+            self.call_rpc(cacher, 'invalidate', keys)
+        except (OSError, RemoteError):
+            pass
+
+    '''
+        Drops keys an owner reports overwritten from the read_through cache
+        Param 1: list of keys'''
+    def invalidate(self, keys):
+        if self.cache is not None:
+            self.cache.invalidate(keys)
+
+    '''
+        Versioned read for caches
+        Param 1: list of keys
+        Param 2: {key: version} of the copies the caller holds already
+        Param 3: node id of the caller if it wants an invalidate when a key is overwritten, else None
+        @:return: ({key: (version, value)} for keys without a current copy at the caller,
+                   [keys whose cached copy is current], [keys this node is not responsible for])'''
+    def read_versions(self, keys, known, cacher=None):
+        found = {}
+        current = []
+        not_owned = []
+        with self.lock:
+            for key in keys:
+                if key in self.keys and self.holds(key):
+                    version = self.versions.get(key)
+                    if version is None:  # stored before a restart or migration
+                        version = self.versions[key] = next(self.version_ids)
+                    if known.get(key) == version:
+                        current.append(key)
+                    else:
+                        found[key] = (version, self.keys[key])
+                    if cacher is not None:
+                        self.cachers.setdefault(key, set()).add(cacher)
+                elif not self.is_responsible(key):
+                    not_owned.append(key)
+        return found, current, not_owned
+
+    '''
+        Reads keys through this node: fresh copies come from its cache, the rest from their owners,
+        which then send an invalidate when one of them is overwritten
+        so a hot key is served by every node clients enter the ring by, not only by its owner
+        Param 1: list of keys
+        @:return: {key: value} for the keys found'''
+    def read_through(self, keys):
+        if self.cache is None:
+            owners = self.find_successors(keys)
+            groups = {}
+            for key, owner in zip(keys, owners):
+                groups.setdefault(owner, []).append(key)
+            values = {}
+            for owner, group in groups.items():
+                values.update(self.call_rpc(owner, 'retrieve_values', group)[0])
+            return values
+        values = {}
+        known = {}
+        ticket = self.cache.ticket()
+        for key in keys:
+            entry = self.cache.lookup(key)
+            if entry and entry[2]:
+                values[key] = entry[1]
+            else:
+                known[key] = entry
+        if not known:
+            return values
+        groups = {}
+        for key, owner in zip(known, self.find_successors(list(known))):
+            groups.setdefault(owner, []).append(key)
+        for owner, group in groups.items():
+            if owner in self.vnodes:  # stored here, nothing to cache
+                values.update(self.retrieve_values(group)[0])
+                continue
+            found, current, not_owned = self.call_rpc(owner, 'read_versions', group,
+                                                      {key: known[key][0] for key in group if known[key] is not None},
+                                                      self.node)
+            for key, (version, value) in found.items():
+                self.cache.put(key, version, value, ticket)
+                values[key] = value
+            for key in current:
+                self.cache.touch(key, known[key][0], ticket)
+                values[key] = known[key][1]
+        return values
     '''
         This method is used to retrieve values from self.keys dictionary
         Param 1: key for which client has request to get its value
-        @:return it return value'''
+        @:return it return value, None if the key is not stored here'''
     def retrieve_value(self, key):
-        if key in self.keys:
-            value = self.keys[key]
-        return value
+        found, not_owned = self.retrieve_values([key])
+        return found.get(key)
+
+    '''
+        This method is used to retrieve many values at once
+        a copy is only served while this process holds its range (see holds), any other is reported not owned
+        Param 1: list of keys
+        @:return: ({key: value} for the keys found, [keys this node is not responsible for])
+        keys in neither are missing'''
+    def retrieve_values(self, keys):
+        found = {}
+        not_owned = []
+        in_transit = []
+        with self.lock:
+            incoming = self.incoming
+            for key in keys:
+                if key in self.keys and self.holds(key):
+                    found[key] = self.keys[key]
+                elif not self.is_responsible(key):
+                    not_owned.append(key)
+                elif incoming and in_range(key, incoming[1], incoming[2]):
+                    in_transit.append(key)
+        if in_transit:
+            found.update(self.fetch_in_transit(incoming[0], in_transit))
+        return found, not_owned
+
+    '''
+        Reads keys that are still being migrated to this node from the node they come from
+        once that node has handed the range over they are read here again
+        @:return: {key: value} for the keys found'''
+    def fetch_in_transit(self, source, keys):
+        found, handed_over = self.call_rpc(source, 'retrieve_values', keys)
+        if handed_over:
+            with self.lock:
+                found.update((key, self.keys[key]) for key in handed_over if key in self.keys)
+        return found
+
+    '''
+        Is this node responsible for id, i.e. is id in (predecessor, self.node]
+        Before the predecessor is known the node accepts everything'''
+    def is_responsible(self, id):
+        np = self.predecessor
+        return np is None or in_half_open(id, np, self.node)
 
     '''
         This method is used to execute 2 main tasks start_server and join_network
-        from two threads
+        from two threads, the second one joins the virtual nodes too (join_all)
         Param 1: port number of existing node in the chord
         Param 2: node number which we want add into the chord network'''
     def create_threads(self, existing_node_address, n_hash_fun):
         t1 = threading.Thread(target = self.start_server, args=[n_hash_fun])
-        t2 = threading.Thread(target = self.join_network, args=[existing_node_address, n_hash_fun])
+        t2 = threading.Thread(target = self.join_all, args=[existing_node_address])
         t1.start()
         t2.start()
         t1.join()
@@ -310,82 +1230,232 @@ class ChordNode:
         Starts up as a server.
         Allocates a new port in the localhost and starts listening
         It listens upto 1000 servers
-        And diverts object to handle_rpc method'''
+        With workers > 0 requests are served by a bounded worker pool (serve_pooled),
+        otherwise every connection gets its own handle_rpc thread'''
     def start_server( self, n_hash_fun):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.bind(('localhost', TEST_BASE + n_hash_fun))
         sock.listen(1000)
+        if self.workers:
+            self.serve_pooled(sock)
+        else:
+            self.serve_threaded(sock)
+
+    '''
+        Serves every accepted connection from its own handle_rpc thread'''
+    def serve_threaded(self, sock):
         while True:
             client, client_addr = sock.accept()
-            self.handle_rpc(client)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.stats.count('accepted')
+            threading.Thread(target=self.handle_rpc, args=[client], daemon=True).start()
+
+    '''
+        Serves every connection from one selector thread and self.worker_pool
+        An idle connection is only watched by the selector; once a request arrives the
+        connection is handed to a worker, which answers exactly one request and gives it back.
+        So the number of open connections is not limited by the number of threads,
+        and a worker waiting on a nested rpc (find_successor, update_finger_table) is stood in
+        for by another one, so the rpcs that nested call causes are still answered'''
+    def serve_pooled(self, sock):
+        sel = selectors.DefaultSelector()
+        wake_r, wake_w = socket.socketpair()
+        ready = Queue()  # connections a worker is done with, to be watched again
+        sel.register(sock, selectors.EVENT_READ)
+        sel.register(wake_r, selectors.EVENT_READ)
+        while True:
+            for key, events in sel.select():
+                if key.fileobj is sock:
+                    client, client_addr = sock.accept()
+                    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.stats.count('accepted')
+                    sel.register(client, selectors.EVENT_READ)
+                elif key.fileobj is wake_r:
+                    wake_r.recv(BACKLOG)
+                    while not ready.empty():
+                        sel.register(ready.get(), selectors.EVENT_READ)
+                else:
+                    sel.unregister(key.fileobj)
+                    self.worker_pool.submit(self.serve_one, key.fileobj, ready, wake_w)
+
+    '''
+        Worker side of serve_pooled: answers one request, then either returns
+        the connection to the selector or closes it if the client has gone'''
+    def serve_one(self, client, ready, wake_w):
+        try:
+            alive = self.serve_request(client)
+        except Exception:
+            traceback.print_exc()
+            alive = False
+        if alive:
+            ready.put(client)
+            wake_w.send(b'\0')
+        else:
+            client.close()
+            self.stats.count('closed')
+
     '''
-        This method receives data from client object
-        unpickle the dumps received from client object(or node in the chord)
-        it dispatches the unpickled data to dispatch_rpc method  
+        This method serves one client connection until the client closes it
         '''
     def handle_rpc(self, client):
-        rpc = client.recv(BUF_SZ)
-        method, arg1, arg2 = pickle.loads(rpc)
-        result = self.dispatch_rpc(method, arg1, arg2)
-        client.sendall(pickle.dumps(result))
+        with client:
+            while self.serve_request(client):
+                pass
+        self.stats.count('closed')
+
+    '''
+        This method reads one length-prefixed request (or node in the chord),
+        dispatches it to dispatch_rpc method and writes the framed result back
+        a request that cannot be decoded or fails is answered with an ERROR reply
+        its time from decoding to the reply being sent is recorded in self.stats,
+        under the name of the virtual node's method for requests sent through 'at'
+        @:return: False once the client has closed the connection'''
+    def serve_request(self, client):
+        try:
+            request = recv_frame(client)
+        except OSError:
+            return False
+        started = time.perf_counter()
+        name, error = 'undecodable', False
+        try:
+            method, args = decode_request(request)
+            name = args[1] if method == 'at' else method
+            reply = encode_reply_parts(self.dispatch_rpc(method, *args))
+        except Exception as e:
+            reply = [encode_reply('{}: {}'.format(type(e).__name__, e), ERROR)]
+            error = True
+        send_frame(client, *reply)
+        self.stats.record(name, time.perf_counter() - started, len(request), sum(map(len, reply)), error)
+        return True
 
     '''
         This method is used to send request to another node in the chord
-        It call rpc if n != self.node else redirects request to dispatch_rpc
+        It call rpc through self.transport (pooled connections unless a simulator gave it another)
+        if n is not hosted by this process else redirects request to dispatch_rpc
         param 1: node identifier 
         param 2: fun_to_invoked
-        param 3 and param 4: parameters which is required for method we want execute'''
-    def call_rpc(self, n, fun_to_invoked, request_param1=None, request_param2=None):
-        if n == self.node:
-            result = self.dispatch_rpc(fun_to_invoked, request_param1, request_param2)
+        param 3 onwards: parameters which is required for method we want execute'''
+    def call_rpc(self, n, fun_to_invoked, *args):
+        vnode = self.vnodes.get(n)
+        if vnode is not None:
+            result = vnode.dispatch_rpc(fun_to_invoked, *args)
         else:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect(('localhost', TEST_BASE + n))
-                s.sendall(pickle.dumps((fun_to_invoked, request_param1, request_param2)))
-                response = s.recv(BUF_SZ)
-                result = pickle.loads(response)
+            with self.worker_pool.blocking():
+                result = self.transport.call_node(n, fun_to_invoked, *args)
         return result
 
     ''' This method passes the request to specific function
+    looked up in self.rpc_handlers
     param 1: fun_to_invoked
-    param 2 and param 3: parameters which is required for method we want execute'''
-    def dispatch_rpc(self, fun_to_invoked, request_param1, request_param2):
-        re = None
-        if fun_to_invoked == 'find_successor':
-            re = self.find_successor(request_param1)
-        elif fun_to_invoked == 'predecessor':
-            re = self.predecessor
-        elif fun_to_invoked == 'update_predecessor':
-            re = self.update_predecessor(request_param1)
-        elif fun_to_invoked == 'successor':
-            re = self.successor
-        elif fun_to_invoked == 'update_finger_table':
-            re = self.update_finger_table(request_param1, request_param2)
-        elif fun_to_invoked == 'closest_preceding_finger':
-            re = self.closest_preceding_finger(request_param1)
-        elif fun_to_invoked == 'predecessor':
-            re = self.predecessor
-        elif fun_to_invoked == 'save_key_value':
-            re = self.save_key_value(request_param1)
-        elif fun_to_invoked == 'retrieve_value':
-            re = self.retrieve_value(request_param1)
-        elif fun_to_invoked == 'generate_keys':
-            re = self.generate_keys(request_param1, request_param2)
-        return re
+    param 2 onwards: parameters which is required for method we want execute'''
+    def dispatch_rpc(self, fun_to_invoked, *args):
+        return self.rpc_handlers[fun_to_invoked](*args)
+
+    '''
+        Runs an rpc sent through this process's port to one of its virtual nodes
+        param 1: node id, param 2: fun_to_invoked, param 3: tuple of its parameters'''
+    def dispatch_at(self, n, fun_to_invoked, args):
+        return self.vnodes[n].dispatch_rpc(fun_to_invoked, *args)
+
+    '''
+        What this process hosts, for the key share report
+        @:return: {'port': port, 'ids': [node ids], 'keys': number of keys stored,
+                   'cache': read_through cache counters if the node has a cache}'''
+    def host_info(self):
+        with self.lock:
+            info = {'port': self.port, 'ids': sorted(self.vnodes), 'keys': len(self.keys)}
+        if self.cache is not None:
+            info['cache'] = self.cache.stats()
+        return info
+
+    '''
+        Counters of this process for chord_stats.py: the rpcs it served and sent, per method
+        with latency histograms and bytes, connections, lookup hops, keys and store size
+        Param 1: stacks of the sampling profiler to include, if it runs (--profile-interval)
+        @:return: dict'''
+    def report_stats(self, profile=PROFILE_STACKS):
+        with self.lock:
+            info = {'time': time.time(), 'port': self.port, 'ids': sorted(self.vnodes), 'keys': len(self.keys),
+                    'successors': {n: node.successor for n, node in self.vnodes.items()},
+                    'predecessors': {n: node.predecessor for n, node in self.vnodes.items()}}
+        info['served'] = self.stats.to_dict()
+        counters = info['served']['counters']
+        info['connections'] = {'open': counters.get('accepted', 0) - counters.get('closed', 0)}
+        sent = getattr(self.transport, 'stats', None)
+        if sent is not None:
+            info['sent'] = sent.to_dict()
+            info['connections']['pooled'] = self.transport.idle_count()
+        info['threads'] = threading.active_count()
+        if isinstance(self.keys, DurableKeyStore):
+            info['store'] = self.keys.disk_usage()
+        if self.cache is not None:
+            info['cache'] = self.cache.stats()
+        if self.sampler is not None and profile:
+            info['profile'] = self.sampler.top(profile)
+        return info
 
 
 '''Main method: requires two arguments
    One : port number of existing node in the chordNode
    Second : node number which we want to add in the chord
-   0, 0 : to add the very first node in the chord'''
+   0, 0 : to add the very first node in the chord
+   --workers : size of the request worker pool, 0 for one thread per connection
+   --data-dir : keep the node's keys in DIR/node-<n> so they survive a restart, in memory only if omitted
+   --fsync : when writes reach the disk: always (before the reply, concurrent writes share an fsync),
+       batch (every 50 ms, a crash may lose the last 50 ms of acknowledged writes) or none
+   --snapshot-bytes : log size at which the store is compacted into a snapshot
+   --migration-chunk : keys per rpc when pulling this node's keys from its successor on join
+   --stabilize-interval, --fix-fingers-interval, --check-predecessor-interval : seconds between
+       rounds of each maintenance task, 0 disables it; --stabilize-interval 0 joins with update_others
+   --replicas : copies kept of every key, the owner's successors hold the extra ones
+   --vnodes : ring positions hosted by this process, the extra ids are hashed from the node number
+       and served on its port; they need stabilization to become known to the other nodes
+   --cache-size, --cache-ttl : entries and seconds of the cache behind read_through, 0 entries for none
+   --profile-interval : seconds between samples of the sampling profiler, 0 (default) to not run it;
+       the hottest stacks come back in the stats rpc, see chord_stats.py --profile'''
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print("Usage: python chord_node.py EXISTINGNODE NODENUMBER")
-        exit(1)
-    existing_node_address = int(sys.argv[1])
-    node_number = int(sys.argv[2])
-    chordNode = ChordNode(node_number)
-    chordNode.create_threads(existing_node_address, node_number)
+    parser = argparse.ArgumentParser(usage='python chord_node.py EXISTINGNODE NODENUMBER [--workers N] '
+                                           '[--data-dir DIR [--fsync MODE] [--snapshot-bytes N]] [--migration-chunk N] '
+                                           '[--stabilize-interval S] [--fix-fingers-interval S] '
+                                           '[--check-predecessor-interval S] [--replicas R] [--vnodes V] '
+                                           '[--cache-size N] [--cache-ttl S] [--profile-interval S]')
+    parser.add_argument('existing_node_address', type=int)
+    parser.add_argument('node_number', type=int)
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--data-dir')
+    parser.add_argument('--fsync', choices=FSYNC_MODES, default='batch')
+    parser.add_argument('--snapshot-bytes', type=int, default=SNAPSHOT_BYTES)
+    parser.add_argument('--migration-chunk', type=int, default=MIGRATION_CHUNK)
+    parser.add_argument('--stabilize-interval', type=float, default=STABILIZE_INTERVAL)
+    parser.add_argument('--fix-fingers-interval', type=float, default=FIX_FINGERS_INTERVAL)
+    parser.add_argument('--check-predecessor-interval', type=float, default=CHECK_PREDECESSOR_INTERVAL)
+    parser.add_argument('--replicas', type=int, default=REPLICAS)
+    parser.add_argument('--vnodes', type=int, default=VNODES)
+    parser.add_argument('--cache-size', type=int, default=0)
+    parser.add_argument('--cache-ttl', type=float, default=CACHE_TTL)
+    parser.add_argument('--profile-interval', type=float, default=0)
+    args = parser.parse_args()
+    if args.vnodes > 1 and args.stabilize_interval <= 0:
+        parser.error('--vnodes needs --stabilize-interval > 0')
+    store = None
+    if args.data_dir:
+        store = DurableKeyStore(os.path.join(args.data_dir, 'node-{}'.format(args.node_number)),
+                                args.fsync, args.snapshot_bytes)
+    chordNode = ChordNode(args.node_number, args.workers, store, args.migration_chunk,
+                          args.stabilize_interval, args.fix_fingers_interval, args.check_predecessor_interval,
+                          args.replicas, cache_size=args.cache_size, cache_ttl=args.cache_ttl,
+                          profile_interval=args.profile_interval)
+    POOL.stats = RpcStats()
+    ids = {args.node_number}
+    for i in range(1, NODES * 4):
+        if len(ids) == min(args.vnodes, NODES):
+            break
+        vnode = hash_key('{}:{}'.format(args.node_number, i), M)
+        if vnode not in ids:
+            ids.add(vnode)
+            chordNode.add_vnode(vnode)
+    chordNode.create_threads(args.existing_node_address, args.node_number)
 
 
 
@@ -1,19 +1,127 @@
+import argparse
 import csv
 import hashlib
-import pickle
-import socket
+import io
+import os
+import random
 import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from queue import Queue
 
+from chord_ring import BLOB_CHUNK, CONSISTENCY_LEVELS, ITERATIVE, LOOKUP_MODES, ONE, RingCache, hash_key
+from chord_rpc import POOL
 
 TEST_BASE = 43544
-BUF_SZ = 4096  # socket recv arg
 M = 3 # FIXME: Test environment, normally = hashlib.sha1().digest_size * 8
+BATCH_SIZE = 1000  # rows resolved and grouped per bulk-load batch
+IN_FLIGHT = 8  # save_key_value batches outstanding at once
+WORKERS = os.cpu_count()  # parse-and-hash processes, 0 = parse in this process
+CHUNK_SIZE = 1 << 20  # bytes of CSV handed to a parse worker at a time
+QUEUE_DEPTH = 16  # parsed batches waiting for the network senders
+PROGRESS_INTERVAL = 5  # seconds between progress lines
+RETRIES = 5  # times rejected keys are re-resolved before the load gives up
+
+
+'''
+    Reads the file in chunks of about chunk_size bytes, each ending on a line break
+    Rows with quoted line breaks inside a field are not supported by this split
+    @:return: generator of bytes'''
+def read_chunks(file_name, chunk_size=CHUNK_SIZE):
+    with open(file_name, 'rb') as f:
+        rest = b''
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                if rest:
+                    yield rest
+                return
+            data = rest + data
+            cut = data.rfind(b'\n') + 1
+            rest = data[cut:]
+            if cut:
+                yield data[:cut]
+
+
+'''
+    Parses and hashes one chunk of CSV, runs inside a parse worker process
+    key is the hash of columns 0 and 3, value is the remaining columns concatenated
+    @:return: (number of rows, {key: value})'''
+def parse_chunk(data, m=M):
+    mask = (1 << m) - 1
+    tail = -((m + 7) // 8)
+    sha1 = hashlib.sha1
+    batch = {}
+    rows = 0
+    for row in csv.reader(io.StringIO(data.decode()), delimiter=','):
+        if not row:
+            continue
+        rows += 1
+        key = int.from_bytes(sha1((row[0] + row[3]).encode()).digest()[tail:], 'big') & mask
+        batch[key] = ''.join(row[1:3] + row[4:])
+    return rows, batch
+
+
+'''
+    Parses a whole file with a pool of worker processes
+    At most two chunks per worker are outstanding, so memory stays flat whatever the file size
+    @:return: generator of (chunk bytes, rows, {key: value}) in file order'''
+def parse_file(file_name, workers=WORKERS, chunk_size=CHUNK_SIZE):
+    if not workers:
+        for data in read_chunks(file_name, chunk_size):
+            yield (len(data),) + parse_chunk(data)
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        window = deque()
+        for data in read_chunks(file_name, chunk_size):
+            window.append((len(data), pool.submit(parse_chunk, data, M)))
+            if len(window) >= 2 * workers:
+                nbytes, future = window.popleft()
+                yield (nbytes,) + future.result()
+        while window:
+            nbytes, future = window.popleft()
+            yield (nbytes,) + future.result()
+
+
+class Progress(object):
+    """
+    Row and byte counters for a load, printing a progress line every interval seconds.
+    """
+
+    def __init__(self, total_bytes, interval=PROGRESS_INTERVAL, out=sys.stderr):
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.out = out
+        self.rows = 0
+        self.bytes = 0
+        self.started = self.reported = time.monotonic()
+
+    def add(self, rows, nbytes):
+        self.rows += rows
+        self.bytes += nbytes
+        now = time.monotonic()
+        if now - self.reported >= self.interval:
+            self.reported = now
+            self.report()
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        print('{} rows, {:.1f}% of input, {:.0f} rows/s, {:.1f} MB/s'.format(
+            self.rows, 100.0 * self.bytes / max(self.total_bytes, 1),
+            self.rows / elapsed, self.bytes / elapsed / 1e6), file=self.out)
 
 ''' 
     Chord populate class which is used to 
     save the key : value to the node present 
     in the chord network'''
 class chord_populate():
+    def __init__(self, lookup=ITERATIVE, consistency=ONE):
+        self.ring = RingCache()
+        self.lookup = lookup  # find_successor mode used when the ring cache is stale
+        self.consistency = consistency  # replicas that must have stored a batch before the owner answers
+
     '''
         This method reads the data from CSV file 
         It extract key and value from each row in the csv file
@@ -24,56 +132,219 @@ class chord_populate():
         with open(file_name) as csvfile:
             readCSV = csv.reader(csvfile, delimiter=',')
             for row in readCSV:
-                row_key = row[0] + row[3]
-                row_value =''
-                for i in [x for x in range(1, len(row)) if x != 3]:
-                    row_value += row[i]
-                result = hashlib.sha1(row_key.encode())
-                n = result.hexdigest()
-                i = int(n, 16)
-                val = divmod(i, 2**M)
-                key = val[1]
+                key, row_value = self.parse_row(row)
                 node_add = self.look_up(existing_port, key)
-                self.save_key(node_add, key, row_value)
+                self.deliver(existing_port, node_add, {key: row_value})
+
+    '''
+        Bulk-load mode of open_file, as a pipeline:
+        the file is read in chunks that worker processes parse and hash (parse_file),
+        parsed rows go in batches of batch_size through a bounded queue to a sender thread,
+        which resolves the owners of a whole batch from the ring cache, groups
+        the rows by owner node and sends every group as one multi-key save_key_value;
+        up to in_flight groups are on the wire at once, at most one per node, so a node
+        stores its groups in file order and a key repeated later in the file keeps its last row
+        Param 1 and Param 2: port number of existing node (None to only parse), file name
+        @:return: number of rows loaded'''
+    def bulk_load(self, existing_port, file_name, batch_size=BATCH_SIZE, in_flight=IN_FLIGHT,
+                  workers=WORKERS, chunk_size=CHUNK_SIZE):
+        progress = Progress(os.path.getsize(file_name))
+        batches = Queue(QUEUE_DEPTH)
+        errors = []
+        sender = threading.Thread(target=self.send_batches, args=[existing_port, batches, in_flight, errors])
+        sender.start()
+        try:
+            for nbytes, rows, parsed in parse_file(file_name, workers, chunk_size):
+                if errors:
+                    break
+                items = list(parsed.items())
+                for i in range(0, len(items), batch_size):
+                    batches.put(dict(items[i:i + batch_size]))
+                progress.add(rows, nbytes)
+        finally:
+            batches.put(None)
+            sender.join()
+        if errors:
+            raise errors[0]
+        progress.report()
+        return progress.rows
+
+    '''
+        Sender side of bulk_load: takes batches off the queue until it gets None
+        After a failure it keeps draining the queue so the parser never blocks on it'''
+    def send_batches(self, existing_port, batches, in_flight, errors):
+        pending = {}
+        with ThreadPoolExecutor(in_flight) as executor:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                if errors or existing_port is None:
+                    continue
+                try:
+                    pending = self.send_batch(existing_port, batch, executor, pending, in_flight)
+                except Exception as e:
+                    errors.append(e)
+            for future in pending.values():
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append(e)
+
+    '''
+        Resolves and sends one bulk-load batch
+        Waits while in_flight sends are outstanding, so memory stays bounded by in_flight batches,
+        and for the send still outstanding to the same node, so each node gets its groups in order
+        @:return: {node number: its send still outstanding}'''
+    def send_batch(self, existing_port, batch, executor, pending, in_flight):
+        for node_add, dic in self.group_by_node(existing_port, batch).items():
+            if node_add in pending:
+                pending.pop(node_add).result()
+            while len(pending) >= in_flight:
+                done, not_done = wait(pending.values(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                pending = {n: future for n, future in pending.items() if future in not_done}
+            pending[node_add] = executor.submit(self.deliver, existing_port, node_add, dic)
+        return pending
+
+    '''
+        Groups {key: value} pairs by the node responsible for them
+        owners come from the ring cache, or from one find_successors call when walk is set
+        @:return: {node number: {key: value}}'''
+    def group_by_node(self, existing_port, batch, walk=False):
+        ids = list(batch)
+        if walk:
+            owners = POOL.call(existing_port, 'find_successors', ids, self.lookup)
+        else:
+            owners = [self.ring.owner(existing_port, key) for key in ids]
+        groups = {}
+        for key, node_add in zip(ids, owners):
+            groups.setdefault(node_add, {})[key] = batch[key]
+        return groups
+
+    '''
+        Saves {key: value} pairs on node_add
+        Keys the node turns down because the ring cache was stale are looked up again
+        with find_successor, the cache is refreshed and they are sent to their real owners
+        Param 1, Param 2 and Param 3: port number of existing node, node number, {key: value} pairs'''
+    def deliver(self, existing_port, node_add, dic):
+        groups = {node_add: dic}
+        for attempt in range(RETRIES):
+            rejected = {}
+            for node_add, dic in groups.items():
+                rejected.update(self.save_keys(node_add, dic))
+            if not rejected:
+                return
+            self.ring.refresh(existing_port)
+            groups = self.group_by_node(existing_port, rejected, walk=True)
+        raise RuntimeError('no node accepted keys {}'.format(sorted(rejected)))
+
+    '''
+        Stores the next size bytes of a binary file as the value of one key, streamed with write_blob
+        in pieces of at most chunk bytes; every piece is read into the same buffer and sent from it
+        without another copy, so memory stays at one piece whatever the size of the value.
+        If the first piece reaches a node no longer responsible for key, the owner is looked up again
+        Param 1, Param 2 and Param 3: port number of existing node, key, binary file object
+        Param 4: bytes to store
+        @:return: node number which stored the value'''
+    def put_blob(self, existing_port, key, source, size, chunk=BLOB_CHUNK):
+        buffer = bytearray(min(chunk, size))
+        view = memoryview(buffer)
+        upload = random.getrandbits(63)
+        n = source.readinto(buffer)
+        node_add = self.look_up(existing_port, key)
+        for attempt in range(RETRIES):
+            if POOL.call_node(node_add, 'write_blob', key, upload, 0, view[:n], size, self.consistency):
+                break
+            self.ring.refresh(existing_port)
+            node_add = POOL.call(existing_port, 'find_successor', key, self.lookup)
+        else:
+            raise RuntimeError('no node accepted key {}'.format(key))
+        offset = n
+        while offset < size:
+            n = source.readinto(view[:size - offset])
+            if not n:
+                raise EOFError('input ended after {} of {} bytes'.format(offset, size))
+            POOL.call_node(node_add, 'write_blob', key, upload, offset, view[:n], size, self.consistency)
+            offset += n
+        return node_add
+
+    '''
+        This method extracts the key and value of a CSV row
+        key is the SHA1 of columns 0 and 3 reduced to the identifier space
+        value is the remaining columns concatenated
+        @:return: (key, value)'''
+    def parse_row(self, row):
+        row_key = row[0] + row[3]
+        row_value =''
+        for i in [x for x in range(1, len(row)) if x != 3]:
+            row_value += row[i]
+        return hash_key(row_key), row_value
     '''
         This method is used to lookup for the node where respected key should be saved
         calls the find successor method to get the node number
         Param 1 and Param 2: port number of existing node, key for which we want to save the key: value pair
-        find_successor : will be the node where keys has to be saved
+        find_successor : will be the node where keys has to be saved,
+        it is answered from the ring cache which walks the ring only once
         @:return: node number'''
     def look_up(self, existing_port, key):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect(('localhost', existing_port))
-            s.sendall(pickle.dumps(('find_successor', key, None)))
-            response = s.recv(BUF_SZ)
-            result = pickle.loads(response)
-        return result
+        return self.ring.owner(existing_port, key)
 
     '''
         This method save key: value pair to the nodes
-        Param 1, Param 2  and Param 3: node number where key value pair has to saved'''
+        Param 1, Param 2  and Param 3: node number where key value pair has to saved
+        @:return: {key: value} if the node is not responsible for key'''
     def save_key(self, node_add, key, row_value):
         #print(node_add, key, row_value)
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect(('localhost', node_add+TEST_BASE))
-            dic = {key: row_value}
-            re = pickle.dumps(dic)
-            s.sendall(pickle.dumps(('save_key_value', re, None)))
-        #     response = s.recv(BUF_SZ)
-        #     result = pickle.loads(response)
-        # return result  ' this is the another change'
+        return self.save_keys(node_add, {key: row_value})
+
+    '''
+        This method saves many key: value pairs on one node with a single rpc
+        Param 1 and Param 2: node number, {key: value} pairs which it is responsible for
+        @:return: {key: value} pairs the node turned down'''
+    def save_keys(self, node_add, dic):
+        return POOL.call_node(node_add, 'save_key_value', dic, self.consistency)
 
 '''
     Main method: requires 2 arguments
     Argument 1: existing port number 
-    Argument 2: file name which has to hashed and send to the chord nodes'''
+    Argument 2: file name which has to hashed and send to the chord nodes
+    --batch-size, --in-flight : bulk-load tuning, --row-by-row : one lookup and one save per row
+    --workers, --chunk-size : parse-and-hash processes and their unit of work
+    --parse-only : run the parse pipeline without sending, to measure it alone
+    --lookup : iterative or recursive find_successor
+    --consistency : one, quorum or all of the key's replicas have it stored before a save returns
+    --blob KEY : store the whole file as the value of KEY, streamed in --blob-chunk byte pieces,
+    for values of any size; read it back with chord_query.py --blob-out'''
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print("Usage: python chord_populate.py EXISTINGNODE_PORT and FILE_NAME")
-        exit(1)
-    existing_node_port = int(sys.argv[1])
-    file_name = sys.argv[2]
-    chordpopulate = chord_populate()
-    chordpopulate.open_file(existing_node_port, file_name)
+    parser = argparse.ArgumentParser(usage='python chord_populate.py EXISTINGNODE_PORT FILE_NAME '
+                                           '[--batch-size N] [--in-flight N] [--workers N] [--chunk-size BYTES] '
+                                           '[--row-by-row] [--parse-only] [--lookup iterative|recursive] '
+                                           '[--consistency one|quorum|all] [--blob KEY [--blob-chunk BYTES]]')
+    parser.add_argument('existing_node_port', type=int)
+    parser.add_argument('file_name')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--in-flight', type=int, default=IN_FLIGHT)
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--row-by-row', action='store_true')
+    parser.add_argument('--parse-only', action='store_true')
+    parser.add_argument('--lookup', choices=LOOKUP_MODES, default=ITERATIVE)
+    parser.add_argument('--consistency', choices=CONSISTENCY_LEVELS, default=ONE)
+    parser.add_argument('--blob')
+    parser.add_argument('--blob-chunk', type=int, default=BLOB_CHUNK)
+    args = parser.parse_args()
+    chordpopulate = chord_populate(args.lookup, args.consistency)
+    if args.blob is not None:
+        with open(args.file_name, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            node_add = chordpopulate.put_blob(args.existing_node_port, hash_key(args.blob), f, size, args.blob_chunk)
+        print('stored {} bytes as {} on node {}'.format(size, args.blob, node_add))
+    elif args.row_by_row:
+        chordpopulate.open_file(args.existing_node_port, args.file_name)
+    else:
+        port = None if args.parse_only else args.existing_node_port
+        chordpopulate.bulk_load(port, args.file_name, args.batch_size, args.in_flight, args.workers, args.chunk_size)
 
     # '/Users/somyakajla/Documents/distributed/lab4/hello.csv'
\ No newline at end of file
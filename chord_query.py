@@ -1,46 +1,284 @@
+import argparse
 import hashlib
-import pickle
-import socket
+import itertools
 import sys
-import rpyc
+import threading
+from collections import Counter
+
+from chord_ring import (BLOB_CHUNK, CONSISTENCY_LEVELS, ITERATIVE, LOOKUP_MODES, ONE, RingCache, hash_key,
+                        replicas_needed)
+from chord_rpc import DIRECTORY, POOL, RemoteError
+from chord_store import ValueCache
 
 TEST_BASE = 43544
-BUF_SZ = 4096  # socket recv arg
 M = 3  # FIXME: Test environment, normally = hashlib.sha1().digest_size * 8
+FAN_OUT = 16  # owner nodes read from in parallel by get_many
+LEAST_OUTSTANDING = 'least-outstanding'  # read from the replica with the fewest keys still being fetched
+ROUND_ROBIN = 'round-robin'  # take turns over a key's replicas
+REPLICA_POLICIES = (LEAST_OUTSTANDING, ROUND_ROBIN)
+CACHE_TTL = 5.0  # seconds a cached value is served without asking a replica whether it is still current
+SHOW_LIMIT = 4096  # bytes of a value printed, a longer one is shown by its size
 ''' 
     Chord query class which is used to 
     retrieve the key : value pair from the nodes present 
     in the chord network'''
 class chord_query():
+    def __init__(self, lookup=ITERATIVE, replicas=1, consistency=ONE, policy=LEAST_OUTSTANDING,
+                 cache_size=0, cache_ttl=CACHE_TTL, via_node=False):
+        self.ring = RingCache()
+        self.fan_out = None  # thread pool for reading from many nodes at once, made on first use
+        self.lookup = lookup  # find_successor mode used when the ring cache is stale
+        self.replicas = replicas  # copies the nodes keep of every key, must match their --replicas
+        self.consistency = consistency  # replicas read per key
+        self.policy = policy
+        self.outstanding = Counter()  # node -> keys being fetched from it
+        self.turn = itertools.count()
+        self.lock = threading.Lock()
+        # off unless asked for: no node tells a client about writes made by others, so a cached value
+        # may be up to cache_ttl seconds out of date
+        self.cache = ValueCache(cache_size, cache_ttl) if cache_size > 0 else None
+        self.via_node = via_node  # read through the entry node's read_through cache instead of the replicas
+
     '''
         This method: finds the node which holds the value for key 
+        the owner comes from the ring cache, so after the first query it costs no lookup rpc
+        while the ring is not known yet (a one-shot query) the owner comes from one find_successor rpc,
+        cheaper than learning the whole ring for a single key
         Param 1, Param 2: port of existing node, key for which we have retrieve the value
         @:return: node number from where we have to get the value of requested key'''
     def find_key(self, existing_port, key):
         hash_key = self.convert_hash(key)
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect(('localhost', existing_port))
-            s.sendall(pickle.dumps(('find_successor', hash_key, None)))
-            response = s.recv(BUF_SZ)
-            node_add = pickle.loads(response)
-            self.retrieve_val(node_add, hash_key)
-            return node_add
+        if self.replicas > 1 or self.via_node or (self.cache is not None and self.ring.nodes):
+            self.show(hash_key, self.fetch_ids(existing_port, [hash_key]).get(hash_key))
+            return self.ring.owner(existing_port, hash_key)
+        if self.ring.nodes:
+            node_add = self.ring.owner(existing_port, hash_key)
+        else:
+            node_add = POOL.call(existing_port, 'find_successor', hash_key, self.lookup)
+        self.retrieve_val(node_add, hash_key, existing_port)
+        return node_add
 
     '''
         This method is used get the value from node
+        Only the first SHOW_LIMIT bytes are read (with read_blob, which sends str values as utf-8),
+        so a large value stored with chord_populate.py --blob costs one small rpc and is shown by its size
+        If the node says it is not responsible for key (the ring cache is stale, or the node is gone)
+        the owner is looked up with find_successor and the ring cache is refreshed
         Param 1: number number where key is stored
         Param 2: key 
-        @:return: value from node'''
-    def retrieve_val(self, node_add, key):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect(('localhost', node_add+TEST_BASE))
-            s.sendall(pickle.dumps(('retrieve_value', key, None)))
-            response = s.recv(BUF_SZ)
-            value = pickle.loads(response)
-            print('##################################################################')
-            print('{key: value}', '{', key, ':', value,'}')
-            print('##################################################################')
-            return value
+        Param 3: port of existing node used to look the owner up again
+        @:return: value from node, at most its first SHOW_LIMIT bytes'''
+    def retrieve_val(self, node_add, key, existing_port=None):
+        try:
+            reply = self.read_head(node_add, key)
+        except OSError:
+            if existing_port is None:
+                raise
+            reply = False
+        if reply is False and existing_port is not None:
+            node_add = POOL.call(existing_port, 'find_successor', key, self.lookup)
+            self.ring.refresh(existing_port)
+            reply = self.read_head(node_add, key)
+        size, value = reply or (None, None)
+        self.show(key, value, size)
+        return value
+
+    '''
+        (size, first SHOW_LIMIT bytes) of the value of key on node_add, None if it is not stored
+        and False if the node does not own key; a value read_blob cannot slice is read whole'''
+    def read_head(self, node_add, key):
+        try:
+            reply = POOL.call_node(node_add, 'read_blob', key, 0, SHOW_LIMIT)
+        except RemoteError:  # neither bytes nor str
+            found, not_owned = POOL.call_node(node_add, 'retrieve_values', [key])
+            return False if not_owned else (None, found.get(key))
+        return reply and (reply[0], reply[2])
+
+    def show(self, key, value, size=None):
+        print('##################################################################')
+        print('{key: value}', '{', key, ':', printable(value, size),'}')
+        print('##################################################################')
+
+    '''
+        Reads the value of one key with read_blob in pieces of at most chunk bytes and writes each piece
+        to out as it arrives, so memory stays at one piece whatever the size of the value.
+        Pieces come from the owner, or from the next replica if the owner is down; the read starts
+        over if the value is overwritten (or the replica changes) part way, which needs a seekable out
+        Param 1, Param 2 and Param 3: port of existing node, key (already hashed), binary file object
+        @:return: size of the value, None if the key is not stored'''
+    def get_blob(self, existing_port, key, out, chunk=BLOB_CHUNK):
+        nodes = self.ring.replicas(existing_port, key, self.replicas)
+        refreshed = False
+        offset = 0
+        version = None
+        while True:
+            try:
+                reply = POOL.call_node(nodes[0], 'read_blob', key, offset, chunk)
+            except OSError:
+                if len(nodes) == 1:
+                    raise
+                nodes = nodes[1:]
+                continue
+            if reply is False and not refreshed:  # the ring cache is stale
+                refreshed = True
+                self.ring.refresh(existing_port)
+                nodes = [POOL.call(existing_port, 'find_successor', key, self.lookup)]
+                continue
+            if not reply:
+                return None
+            size, current, piece = reply
+            if offset and current != version:
+                if not out.seekable():
+                    raise RuntimeError('value of {} changed while it was read'.format(key))
+                out.seek(0)
+                out.truncate()
+                offset = 0
+                continue
+            version = current
+            out.write(piece)
+            offset += len(piece)
+            if offset >= size:
+                return size
+
+    '''
+        Multi-get: reads many keys with one retrieve_values rpc per owner node, all owners in parallel
+        Param 1, Param 2: port of existing node, list of keys
+        @:return: ([(key, value)] in input order, [keys which are not stored in the chord])
+        value is None for a missing key'''
+    def get_many(self, existing_port, keys):
+        ids = {key: hash_key(key) for key in keys}
+        values = self.fetch_ids(existing_port, set(ids.values()))
+        results = [(key, values.get(ids[key])) for key in keys]
+        missing = [key for key in keys if ids[key] not in values]
+        return results, missing
+
+    '''
+        Reads ids grouped by node, each id from as many of its replicas as the consistency level asks for
+        ids a stale owner turned down are looked up again with find_successors and read once more
+        ids with a fresh copy in the cache are not read at all, whatever the consistency level
+        @:return: {id: value} for the ids found'''
+    def fetch_ids(self, existing_port, ids):
+        cached = {}
+        if self.cache is not None:
+            for id in ids:
+                entry = self.cache.lookup(id)
+                if entry and entry[2]:
+                    cached[id] = entry[1]
+            ids = [id for id in ids if id not in cached]
+        if self.via_node:
+            cached.update(POOL.call(existing_port, 'read_through', list(ids)))
+            return cached
+        needed = replicas_needed(self.consistency, self.replicas)
+        groups = {}
+        for id in ids:
+            for node_add in self.choose(self.ring.replicas(existing_port, id, self.replicas), needed):
+                groups.setdefault(node_add, []).append(id)
+        answers = {}
+        for attempt in range(2):
+            not_owned = set()
+            if len(groups) > 1:
+                replies = self.executor().map(self.fetch_node, groups.items())
+            else:  # no thread hand-off for a single node
+                replies = [self.fetch_node(group) for group in groups.items()]
+            for node_found, node_not_owned in replies:
+                for id, value in node_found.items():
+                    answers.setdefault(id, []).append(value)
+                not_owned.update(node_not_owned)
+            not_owned.difference_update(answers)
+            if not not_owned:
+                break
+            self.ring.refresh(existing_port)
+            not_owned = sorted(not_owned)
+            owners = POOL.call(existing_port, 'find_successors', not_owned, self.lookup)
+            groups = {}
+            for id, node_add in zip(not_owned, owners):
+                groups.setdefault(node_add, []).append(id)
+                self.claim(node_add, 1)
+        # the most common answer wins, compared with == as a bytes value may be an unhashable bytearray
+        cached.update((id, max(values, key=values.count)) for id, values in answers.items())
+        return cached
+
+    '''
+        The fan-out thread pool; concurrent.futures is imported here, on first use,
+        so that a one-key query does not pay for importing it'''
+    def executor(self):
+        with self.lock:
+            if self.fan_out is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self.fan_out = ThreadPoolExecutor(FAN_OUT)
+            return self.fan_out
+
+    def close(self):
+        if self.fan_out is not None:
+            self.fan_out.shutdown()
+
+    '''
+        Picks count of a key's replicas to read from and counts the key as outstanding on them
+        least-outstanding takes the replicas with the fewest keys in flight, the owner first on a tie;
+        round-robin starts one replica further along every time
+        Param 1: [owner, successor, ...] as from RingCache.replicas
+        Param 2: how many to read from
+        @:return: [node number, ...]'''
+    def choose(self, replicas, count):
+        with self.lock:
+            if self.policy == ROUND_ROBIN:
+                start = next(self.turn) % len(replicas)
+                chosen = (replicas[start:] + replicas[:start])[:count]
+            else:
+                chosen = sorted(replicas, key=self.outstanding.__getitem__)[:count]
+            for node_add in chosen:
+                self.outstanding[node_add] += 1
+        return chosen
+
+    def claim(self, node_add, keys):
+        with self.lock:
+            self.outstanding[node_add] += keys
+
+    '''
+        One retrieve_values rpc, a node that cannot be reached counts as not owning its ids
+        with the cache on it is a read_versions rpc instead, which only sends values the cache lacks
+        Param 1: (node number, [ids])
+        @:return: ({id: value}, [ids not owned])'''
+    def fetch_node(self, group):
+        node_add, ids = group
+        try:
+            if self.cache is None:
+                return POOL.call_node(node_add, 'retrieve_values', ids)
+            ticket = self.cache.ticket()
+            held = {id: self.cache.entry(id) for id in ids}
+            known = {id: entry[0] for id, entry in held.items() if entry is not None}
+            found, current, not_owned = POOL.call_node(node_add, 'read_versions', ids, known, None)
+            values = {}
+            for id, (version, value) in found.items():
+                self.cache.put(id, version, value, ticket)
+                values[id] = value
+            for id in current:
+                self.cache.touch(id, known[id], ticket)
+                values[id] = held[id][1]
+            return values, not_owned
+        except OSError:
+            return {}, ids
+        finally:
+            with self.lock:
+                self.outstanding[node_add] -= len(ids)
+    '''
+        Reports how the identifier space and the stored keys split over the processes in the ring,
+        each virtual node's share of the ring is the arc from its predecessor up to it
+        Param 1: port of existing node
+        @:return: [(port, [node ids], share of the ring, keys, share of the keys)], busiest first'''
+    def key_share(self, existing_port):
+        self.ring.refresh(existing_port, None)
+        nodes = self.ring.nodes
+        hosts = {}
+        for i, n in enumerate(nodes):
+            arc = (n - nodes[i - 1]) % 2 ** M or 2 ** M
+            ids, width = hosts.get(DIRECTORY.port(n), ([], 0))
+            hosts[DIRECTORY.port(n)] = ids + [n], width + arc
+        keys = {port: POOL.call(port, 'host_info')['keys'] for port in hosts}
+        total = max(sum(keys.values()), 1)
+        report = [(port, ids, width / 2 ** M, keys[port], keys[port] / total) for port, (ids, width) in hosts.items()]
+        return sorted(report, key=lambda row: row[3], reverse=True)
+
     '''
         This methos is used to convert the hash value 
         Param 1: value which has to be hashed
@@ -53,16 +291,95 @@ class chord_query():
         val = divmod(i, 2**M)
         key = val[1]
         return key
+
+
+'''
+    A value as it is printed: bytes (a memoryview when large) as text, or only their size
+    when there are more than SHOW_LIMIT of them, which --blob-out reads to a file
+    Param 1, Param 2: value, its full size if value is only the head of it'''
+def printable(value, size=None):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        size = len(value) if size is None else size
+        if size > SHOW_LIMIT:
+            return '<{} bytes, read it with --blob-out FILE>'.format(size)
+        return bytes(value).decode('utf-8', 'replace')
+    return value
+
+
 '''
     Main method : requires two arguments
     Argument 1: existing port number
-    Argument 2: key for which we want to get value from chord network'''
+    Argument 2: key for which we want to get value from chord network,
+    more keys make it a multi-get, - reads keys from stdin and --file FILE reads them from a file
+    --lookup : iterative or recursive find_successor
+    --replicas : copies the nodes keep of every key, as given to chord_node.py
+    --consistency : read one, a quorum or all of a key's replicas, the most common value wins
+    --replica-policy : least-outstanding or round-robin choice of the replicas to read
+    --key-share : print each process's share of the ring and of the keys instead
+    --cache-size, --cache-ttl : entries and seconds of the client's value cache, none by default;
+    writes by other clients are not seen until an entry is cache-ttl seconds old
+    --via-node : read through the entry node and its cache (chord_node.py --cache-size)
+    --blob-out FILE : write the value of the single KEY to FILE (- for stdout) piece by piece,
+    for large values stored with chord_populate.py --blob'''
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print("Usage: python chord_query.py EXISTINGNODE_PORT and KEY")
-        exit(1)
-    existing_node_port = int(sys.argv[1])
-    key = sys.argv[2]
-    chordquery = chord_query()
-    chordquery.find_key(existing_node_port, key)
+    parser = argparse.ArgumentParser(usage='python chord_query.py EXISTINGNODE_PORT [KEY ...] [--file FILE] '
+                                           '[--lookup iterative|recursive] [--replicas R] '
+                                           '[--consistency one|quorum|all] '
+                                           '[--replica-policy least-outstanding|round-robin] [--key-share] '
+                                           '[--cache-size N] [--cache-ttl S] [--via-node] [--blob-out FILE]')
+    parser.add_argument('existing_node_port', type=int)
+    parser.add_argument('keys', nargs='*')
+    parser.add_argument('--file')
+    parser.add_argument('--lookup', choices=LOOKUP_MODES, default=ITERATIVE)
+    parser.add_argument('--replicas', type=int, default=1)
+    parser.add_argument('--consistency', choices=CONSISTENCY_LEVELS, default=ONE)
+    parser.add_argument('--replica-policy', choices=REPLICA_POLICIES, default=LEAST_OUTSTANDING)
+    parser.add_argument('--key-share', action='store_true')
+    parser.add_argument('--cache-size', type=int, default=0)
+    parser.add_argument('--cache-ttl', type=float, default=CACHE_TTL)
+    parser.add_argument('--via-node', action='store_true')
+    parser.add_argument('--blob-out')
+    args = parser.parse_args()
+    keys = []
+    for key in args.keys:
+        if key == '-':
+            keys.extend(line.rstrip('\n') for line in sys.stdin)
+        else:
+            keys.append(key)
+    if args.file:
+        with open(args.file) as f:
+            keys.extend(line.rstrip('\n') for line in f)
+    if not keys and not args.key_share:
+        parser.error('no keys given')
+    chordquery = chord_query(args.lookup, args.replicas, args.consistency, args.replica_policy,
+                             args.cache_size, args.cache_ttl, args.via_node)
+    if args.blob_out:
+        if len(keys) != 1:
+            parser.error('--blob-out reads exactly one key')
+        if args.blob_out == '-':
+            size = chordquery.get_blob(args.existing_node_port, hash_key(keys[0]), sys.stdout.buffer)
+        else:
+            with open(args.blob_out, 'wb') as f:
+                size = chordquery.get_blob(args.existing_node_port, hash_key(keys[0]), f)
+        print('{key: missing}' if size is None else '{} bytes'.format(size), file=sys.stderr)
+    elif args.key_share:
+        report = chordquery.key_share(args.existing_node_port)
+        print('{:>6} {:>7} {:>7} {:>7}  {}'.format('port', 'ring', 'keys', 'share', 'node ids'))
+        for port, ids, ring_share, keys_held, key_share in report:
+            print('{:>6} {:>6.1%} {:>7} {:>6.1%}  {}'.format(port, ring_share, keys_held, key_share, ids))
+        shares = [row[4] for row in report]
+        print('busiest process holds {:.2f}x the mean key share'.format(max(shares) * len(shares)))
+    elif len(keys) == 1 and not args.file:
+        chordquery.find_key(args.existing_node_port, keys[0])
+    else:
+        results, missing = chordquery.get_many(args.existing_node_port, keys)
+        for key, value in results:
+            if value is None:
+                print('{key: missing}', '{', key, '}')
+            else:
+                print('{key: value}', '{', key, ':', printable(value), '}')
+        print('{} keys, {} missing'.format(len(keys), len(missing)), file=sys.stderr)
+        if chordquery.cache is not None:
+            print('cache {}'.format(chordquery.cache.stats()), file=sys.stderr)
+    chordquery.close()
 
@@ -0,0 +1,137 @@
+import hashlib
+from bisect import bisect_left
+
+from chord_rpc import DIRECTORY, POOL
+
+TEST_BASE = 43544
+M = 3 # FIXME: Test environment, normally = hashlib.sha1().digest_size * 8
+ITERATIVE = 'iterative'  # find_successor walks the ring from the asking node
+RECURSIVE = 'recursive'  # find_successor is forwarded node to node and answered straight back
+LOOKUP_MODES = (ITERATIVE, RECURSIVE)
+ONE = 'one'  # a read or write is done once one replica has answered
+QUORUM = 'quorum'  # ... once a majority of the replicas have
+ALL = 'all'  # ... once every replica has
+CONSISTENCY_LEVELS = (ONE, QUORUM, ALL)
+BLOB_CHUNK = 1 << 20  # bytes per write_blob / read_blob piece, bounds the memory a large value costs in transit
+RING_WALK = 64  # successor rpcs one RingCache.refresh makes at most, the rest of a larger ring is learnt lazily
+
+
+'''
+    Hashes a key into the identifier space
+    Only the low M bits of the SHA1 digest are kept, read straight from the digest bytes
+    @:return: int key'''
+def hash_key(key, m=M):
+    digest = hashlib.sha1(key.encode()).digest()
+    return int.from_bytes(digest[-((m + 7) // 8):], 'big') & ((1 << m) - 1)
+
+
+'''
+    How many of replicas copies a read or write at this consistency level has to reach
+    @:return: int'''
+def replicas_needed(level, replicas):
+    if level == ONE:
+        return 1
+    if level == QUORUM:
+        return replicas // 2 + 1
+    return replicas
+
+
+class RingCache(object):
+    """
+    Client-side copy of the ring membership, used to resolve key owners without a find_successor walk.
+
+    Refreshing follows successor pointers from the entry node, at most RING_WALK of them, and every
+    node found that way is cached with its predecessor, i.e. the arc (predecessor, node] it owns.
+    The owner of a key in a cached arc is found by bisection; any other key is looked up once with
+    find_successor and the owner's arc is cached from the answer, so a ring larger than the walk
+    fills in as it is used instead of costing one rpc per node up front.
+    Callers refresh the cache when a node answers that it no longer owns a key.
+
+    >>> rc = RingCache()
+    >>> rc.learn([1, 4, 6], closed=True)
+    >>> rc.owner(None, 2), rc.owner(None, 4), rc.owner(None, 7)
+    (4, 4, 1)
+    >>> rc.replicas(None, 5, 2), rc.replicas(None, 5, 5)
+    ([6, 1], [6, 1, 4])
+    """
+
+    def __init__(self, pool=POOL, directory=DIRECTORY):
+        self.pool = pool
+        self.directory = directory  # ports of virtual nodes, learnt from the entry node
+        self.nodes = []  # sorted ids of the nodes known
+        self.preds = {}  # node id -> its predecessor, for the nodes whose arc is known
+
+    '''
+        Relearns the ring by walking successor pointers from the entry node,
+        along with the ports of any virtual nodes
+        Param 1: port number of existing node
+        Param 2: successors to follow at most, None for the whole ring'''
+    def refresh(self, existing_port, limit=RING_WALK):
+        self.directory.merge(self.pool.call(existing_port, 'directory'))
+        start = existing_port - TEST_BASE
+        nodes = [start]
+        n = self.pool.call(existing_port, 'successor')
+        while n != start and len(nodes) < 2 ** M and (limit is None or len(nodes) < limit):
+            nodes.append(n)
+            n = self.pool.call_node(n, 'successor', directory=self.directory)
+        self.nodes = []
+        self.preds = {}
+        self.learn(nodes, closed=n == start)
+
+    '''
+        Caches a run of consecutive nodes, in ring order: each one's arc runs from the node before it
+        Param 1: [node number, its successor, ...]
+        Param 2: whether the run is the whole ring, so that the first node follows the last'''
+    def learn(self, run, closed=False):
+        for pred, n in zip(run, run[1:]):
+            self.preds[n] = pred
+        if closed:
+            self.preds[run[0]] = run[-1]
+        self.nodes = sorted(set(self.nodes).union(run))
+
+    '''
+        Finds the node responsible for key from the cached ring, learning the ring first if needed
+        and the owner's arc if key is outside the arcs known
+        Param 1 and Param 2: port number of existing node, key
+        @:return: node number'''
+    def owner(self, existing_port, key):
+        nodes = self.nodes
+        if not nodes:
+            self.refresh(existing_port)
+            nodes = self.nodes
+        i = bisect_left(nodes, key)
+        n = nodes[i] if i < len(nodes) else nodes[0]
+        pred = self.preds.get(n)
+        if pred is not None and 0 < (key - pred) % 2 ** M <= ((n - pred) % 2 ** M or 2 ** M):
+            return n
+        n = self.pool.call(existing_port, 'find_successor', key)
+        pred = self.pool.call_node(n, 'predecessor', directory=self.directory)
+        self.learn([n] if pred is None else [pred, n])
+        return n
+
+    '''
+        The nodes holding copies of key: its owner followed by the owner's successors,
+        asked of the owner when they are not all cached
+        Param 1, Param 2 and Param 3: port number of existing node, key, replication factor
+        @:return: [node number, ...], at most one entry per node in the ring'''
+    def replicas(self, existing_port, key, replicas):
+        owner = self.owner(existing_port, key)
+        nodes = self.nodes
+        chain = [owner]
+        i = bisect_left(nodes, owner)
+        while len(chain) < replicas:
+            i = (i + 1) % len(nodes)
+            if nodes[i] == owner:
+                return chain
+            if self.preds.get(nodes[i]) != chain[-1]:
+                break
+            chain.append(nodes[i])
+        else:
+            return chain
+        chain = [owner]
+        for n in self.pool.call_node(owner, 'successor_list', directory=self.directory):
+            if n == owner:
+                break
+            chain.append(n)
+        self.learn(chain)
+        return chain[:replicas]
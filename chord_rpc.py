@@ -0,0 +1,207 @@
+import select
+import socket
+import struct
+import threading
+import time
+
+from chord_codec import ERROR, decode_reply, encode_request_parts
+
+
+HOST = 'localhost'
+TEST_BASE = 43544  # a node id n is served on port TEST_BASE+n unless the directory says otherwise
+HEADER = struct.Struct('!I')  # 4-byte big-endian payload length in front of every message
+MAX_IDLE = 8  # idle connections kept open per peer
+CONNECT_TIMEOUT = 5.0  # seconds to open a connection to a peer
+CALL_TIMEOUT = 30.0  # seconds a call waits on the peer, a peer that hangs counts as failed after it
+# rpcs that only read, so they can be sent again if a reused connection breaks after the request went out
+IDEMPOTENT = frozenset(['find_successor', 'find_successors', 'predecessor', 'successor', 'closest_preceding_finger',
+                        'retrieve_value', 'retrieve_values', 'successor_list', 'directory', 'host_info',
+                        'read_versions', 'read_through', 'invalidate', 'stats', 'read_blob'])
+
+
+class RemoteError(Exception):
+    """ The peer received the rpc but it failed there; carries the peer's error message """
+
+
+'''
+    Frames one encoded message onto the socket: length prefix followed by the payload
+    The payload may come in several buffers (encode_request_parts); they go out with
+    scatter-gather sendmsg calls, so neither the prefix nor large values are copied into one message
+    Param 1: connected socket
+    Param 2 onwards: bytes-like pieces of a chord_codec message'''
+def send_frame(sock, *parts):
+    buffers = [HEADER.pack(sum(map(len, parts)))]
+    buffers.extend(parts)
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if sent:
+            buffers[0] = memoryview(buffers[0])[sent:]
+
+
+'''
+    Reads exactly size bytes from the socket
+    raises ConnectionError if the peer closes the connection part way
+    @:return: bytearray of length size'''
+def recv_exact(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    got = 0
+    while got < size:
+        n = sock.recv_into(view[got:], size - got)
+        if n == 0:
+            raise ConnectionError('connection closed by peer')
+        got += n
+    return buf
+
+
+'''
+    Reads one length-prefixed message from the socket
+    @:return: bytearray payload'''
+def recv_frame(sock):
+    size, = HEADER.unpack(recv_exact(sock, HEADER.size))
+    return recv_exact(sock, size)
+
+
+'''
+    Opens a new connection to a peer with Nagle turned off,
+    request/response traffic on a long-lived connection would otherwise stall on delayed acks
+    Param 2: seconds every later send and receive on the connection may block, None for no limit'''
+def connect(port, timeout=CALL_TIMEOUT):
+    sock = socket.create_connection((HOST, port), CONNECT_TIMEOUT)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.settimeout(timeout)
+    return sock
+
+
+'''
+    Is an idle pooled connection still usable: the peer has neither closed it nor sent anything unasked
+    one poll that does not wait, so a connection to a restarted peer is dropped before a request goes out on it'''
+def is_open(sock):
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    return not poller.poll(0)
+
+
+class Directory(dict):
+    """
+    node id -> port of the process hosting it, for virtual node ids that share another node's port.
+
+    Ids not listed are served on their own port, TEST_BASE + id. Nodes pass the listed ids on
+    to each other while stabilizing, and clients fetch them from the node they enter the ring by.
+    """
+
+    def port(self, n):
+        return self.get(n, TEST_BASE + n)
+
+    def merge(self, entries, local=()):
+        """ Take in entries learnt from a peer, other than those for the ids in local """
+        if entries:
+            self.update((n, port) for n, port in entries.items() if n not in local)
+
+
+class ConnectionPool(object):
+    """
+    Per-peer pool of long-lived connections.
+
+    A connection is checked out for exactly one request/response exchange, so
+    any number of threads can call the same peer at once; each gets its own socket
+    and the socket goes back to the idle list afterwards.
+
+    A call that fails on a reused connection is sent again on another one only if the request
+    never fully went out, or if the rpc is in IDEMPOTENT; otherwise it may have run at the peer
+    already and the error goes to the caller. Every send and receive is bounded by timeout.
+    """
+
+    def __init__(self, max_idle=MAX_IDLE, timeout=CALL_TIMEOUT):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.idle = {}  # port -> [socket, ...]
+        self.lock = threading.Lock()
+        self.stats = None  # an RpcStats recording every call made through the pool, if set
+
+    def call(self, port, method, *args):
+        """ Run method(*args) on the peer listening on port and return its result, raises RemoteError if it failed there """
+        started = time.perf_counter()
+        name = args[1] if method == 'at' else method
+        request = encode_request_parts(method, args)
+        while True:
+            sock, reused = self.checkout(port)
+            sent = False
+            try:
+                send_frame(sock, *request)
+                sent = True
+                reply = recv_frame(sock)
+            except OSError as e:
+                sock.close()
+                if reused and (not sent or name in IDEMPOTENT) and not isinstance(e, socket.timeout):
+                    continue  # the peer dropped an idle connection and has not run the request, try the next one
+                if self.stats is not None:
+                    self.stats.record(name, time.perf_counter() - started, 0, sum(map(len, request)), True)
+                raise
+            self.checkin(port, sock)
+            status, result = decode_reply(reply)
+            if self.stats is not None:
+                self.stats.record(name, time.perf_counter() - started, len(reply), sum(map(len, request)),
+                                  status == ERROR)
+            if status == ERROR:
+                raise RemoteError(result)
+            return result
+
+    def call_node(self, n, method, *args, directory=None):
+        """ Run method(*args) on node id n, sent through 'at' when n is a virtual node sharing a port """
+        port = (directory if directory is not None else DIRECTORY).get(n)
+        if port is None:
+            return self.call(TEST_BASE + n, method, *args)
+        return self.call(port, 'at', n, method, args)
+
+    def checkout(self, port):
+        while True:
+            with self.lock:
+                conns = self.idle.get(port)
+                if not conns:
+                    break
+                sock = conns.pop()
+            if is_open(sock):
+                return sock, True
+            sock.close()
+        if self.stats is not None:
+            self.stats.count('connects')
+        return connect(port, self.timeout), False
+
+    def checkin(self, port, sock):
+        with self.lock:
+            conns = self.idle.setdefault(port, [])
+            if len(conns) < self.max_idle:
+                conns.append(sock)
+                return
+        sock.close()
+
+    def idle_count(self):
+        """ Connections kept open for reuse, over all peers """
+        with self.lock:
+            return sum(len(conns) for conns in self.idle.values())
+
+    def discard_node(self, n, directory=None):
+        """ Close the idle connections to the process hosting node id n """
+        self.discard((directory if directory is not None else DIRECTORY).port(n))
+
+    def discard(self, port):
+        """ Close every idle connection to port, e.g. once the peer is known to be gone """
+        with self.lock:
+            conns = self.idle.pop(port, [])
+        for sock in conns:
+            sock.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for sock in conns:
+                sock.close()
+
+
+POOL = ConnectionPool()  # shared by every caller in the process
+DIRECTORY = Directory()  # likewise
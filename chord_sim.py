@@ -0,0 +1,336 @@
+import argparse
+import contextlib
+import heapq
+import io
+import itertools
+import json
+import random
+import sys
+import time
+from bisect import bisect_left, insort
+from collections import Counter
+
+from chord_node import SUCCESSOR_LIST, TEST_BASE, ChordNode, set_id_bits
+from chord_ring import hash_key
+from chord_rpc import RemoteError
+from chord_stats import print_report, summary
+
+BITS = 32  # identifier bits for simulated rings
+NODES = 1000  # physical nodes built before the run
+LATENCY = (0.005, 0.05)  # one-way message delay in seconds, drawn uniformly from this range
+STABILIZE_INTERVAL = 1.0  # virtual seconds between maintenance rounds of every node
+FIX_FINGERS_INTERVAL = 1.0
+CHECK_PREDECESSOR_INTERVAL = 2.0
+
+
+class MemoryTransport(object):
+    """
+    In-process transport for ChordNode.call_rpc: an rpc is a direct call of the target node.
+
+    Every message is counted by method, and its round trip (two draws from latency) is added to
+    elapsed, so the caller can tell what one operation cost. A node that is not registered is
+    down and refuses the call like a closed port would; an error raised at the target comes back
+    as RemoteError, as it does over the network.
+    """
+
+    def __init__(self, latency=LATENCY, rng=None):
+        self.latency = latency
+        self.rng = rng or random.Random()
+        self.nodes = {}  # node id -> ChordNode
+        self.messages = Counter()  # method -> rpcs sent
+        self.elapsed = 0.0  # simulated seconds spent in rpcs
+
+    def call_node(self, n, method, *args, directory=None):
+        self.messages[method] += 1
+        self.elapsed += self.rng.uniform(*self.latency) + self.rng.uniform(*self.latency)
+        node = self.nodes.get(n)
+        if node is None:
+            raise ConnectionRefusedError('node {} is down'.format(n))
+        try:
+            return node.dispatch_rpc(method, *args)
+        except Exception as e:
+            raise RemoteError('{}: {}'.format(type(e).__name__, e)) from e
+
+    def discard_node(self, n, directory=None):
+        pass
+
+    def measure(self):
+        """ Snapshot to pass to cost() once an operation is over """
+        return Counter(self.messages), self.elapsed
+
+    def cost(self, snapshot):
+        """ (messages by method, simulated seconds) spent since measure() returned snapshot """
+        messages, elapsed = snapshot
+        return self.messages - messages, self.elapsed - elapsed
+
+
+class Simulator(object):
+    """
+    Discrete-event simulation of a ring of ChordNode objects in one process.
+
+    Events (joins, failures, lookups and every node's stabilize, fix_fingers and check_predecessor
+    rounds) are kept in a heap by virtual time. An event runs to completion when it is popped:
+    the rpcs it makes go through a MemoryTransport, which charges their simulated latency to the
+    operation instead of sleeping, so the clock only moves between events. Lookups are the
+    iterative find_successor; recursive lookups need real threads and are not simulated.
+
+    >>> sim = Simulator(bits=16, seed=7)
+    >>> sim.build(50)
+    >>> report = sim.run_lookups(200)
+    >>> report['correct'] == 200, report['failed']
+    (True, 0)
+    """
+
+    def __init__(self, bits=BITS, latency=LATENCY, seed=None, vnodes=1,
+                 stabilize_interval=STABILIZE_INTERVAL, fix_fingers_interval=FIX_FINGERS_INTERVAL,
+                 check_predecessor_interval=CHECK_PREDECESSOR_INTERVAL):
+        set_id_bits(bits)
+        self.bits = bits
+        self.rng = random.Random(seed)
+        self.transport = MemoryTransport(latency, self.rng)
+        self.vnodes = vnodes
+        self.intervals = (stabilize_interval, fix_fingers_interval, check_predecessor_interval)
+        self.events = []  # heap of (time, seq, function, args)
+        self.seq = itertools.count()
+        self.now = 0.0
+        self.ids = []  # sorted ids of the live nodes, the oracle lookups are checked against
+        self.hosts = {}  # node id -> physical node it belongs to
+        self.host_ids = itertools.count()
+        self.lookups = {'correct': 0, 'wrong': 0, 'dead': 0, 'failed': 0, 'hops': [], 'messages': [], 'latency': []}
+        self.joins = {'messages': [], 'latency': [], 'by_method': Counter(), 'failed': 0}
+        self.failures = 0
+        self.maintenance = Counter()  # rpcs sent by maintenance rounds
+        self.maintenance_failed = 0
+
+    def schedule(self, delay, function, *args):
+        heapq.heappush(self.events, (self.now + delay, next(self.seq), function, args))
+
+    def run(self, until):
+        """ Run events in time order up to virtual time until """
+        while self.events and self.events[0][0] <= until:
+            self.now, seq, function, args = heapq.heappop(self.events)
+            function(*args)
+        self.now = until
+
+    def new_id(self):
+        while True:
+            n = self.rng.getrandbits(self.bits)
+            if n not in self.transport.nodes:
+                return n
+
+    def new_node(self, n):
+        return ChordNode(n, workers=0, transport=self.transport, stabilize_interval=self.intervals[0],
+                         fix_fingers_interval=self.intervals[1], check_predecessor_interval=self.intervals[2])
+
+    def owner(self, id):
+        i = bisect_left(self.ids, id)
+        return self.ids[i] if i < len(self.ids) else self.ids[0]
+
+    '''
+        Builds a converged ring of count physical nodes, vnodes ids each, without any messages:
+        every finger, predecessor and successor list is set straight from the sorted ids'''
+    def build(self, count):
+        for i in range(count):
+            host = next(self.host_ids)
+            for v in range(self.vnodes):
+                n = self.new_id()
+                self.transport.nodes[n] = self.new_node(n)
+                self.hosts[n] = host
+                insort(self.ids, n)
+        for i, n in enumerate(self.ids):
+            node = self.transport.nodes[n]
+            for k in range(1, self.bits + 1):
+                node.finger.node[k] = self.owner(node.finger.start[k])
+            node.predecessor = self.ids[i - 1]
+            node.successor_list = [self.ids[(i + j) % len(self.ids)] for j in range(1, SUCCESSOR_LIST + 1)]
+        for n in self.ids:
+            self.start_maintenance(n)
+
+    '''
+        Stores count keys on their owners directly, for the key balance report'''
+    def load_keys(self, count):
+        for i in range(count):
+            id = hash_key('key{}'.format(i), self.bits)
+            self.transport.nodes[self.owner(id)].keys[id] = 'value{}'.format(i)
+
+    def start_maintenance(self, n):
+        node = self.transport.nodes[n]
+        for task, interval in zip((node.stabilize, node.fix_fingers, node.check_predecessor), self.intervals):
+            if interval > 0:
+                self.schedule(self.rng.uniform(0, interval), self.maintain, n, task, interval)
+
+    def maintain(self, n, task, interval):
+        if n not in self.transport.nodes:
+            return  # failed meanwhile
+        snapshot = self.transport.measure()
+        try:
+            task()
+        except (OSError, RemoteError):
+            self.maintenance_failed += 1
+        self.maintenance.update(self.transport.cost(snapshot)[0])
+        self.schedule(interval, self.maintain, n, task, interval)
+
+    '''
+        One node joins through a random live node, its messages and simulated time are recorded'''
+    def join(self):
+        n = self.new_id()
+        node = self.new_node(n)
+        self.transport.nodes[n] = node
+        self.hosts[n] = next(self.host_ids)
+        bootstrap = self.rng.choice(self.ids)
+        snapshot = self.transport.measure()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):  # migration progress lines
+                node.join_network(TEST_BASE + bootstrap, n)
+        except (OSError, RemoteError):
+            del self.transport.nodes[n]
+            self.joins['failed'] += 1
+            return
+        messages, elapsed = self.transport.cost(snapshot)
+        self.joins['messages'].append(sum(messages.values()))
+        self.joins['latency'].append(elapsed)
+        self.joins['by_method'].update(messages)
+        insort(self.ids, n)
+        self.start_maintenance(n)
+
+    '''
+        A random node crashes: it stops answering and its keys are gone'''
+    def fail(self):
+        if len(self.ids) <= 1:
+            return
+        n = self.ids.pop(self.rng.randrange(len(self.ids)))
+        del self.transport.nodes[n]
+        self.failures += 1
+
+    '''
+        find_successor of a random id from a random live node, checked against the live ring
+        an answer that is a crashed node, still the successor of its predecessor until stabilize
+        notices, is counted as dead rather than wrong; failed lookups are those that raised
+        hops are the closest_preceding_finger rpcs, i.e. nodes the lookup was passed through'''
+    def lookup(self):
+        id = self.rng.getrandbits(self.bits)
+        start = self.transport.nodes[self.rng.choice(self.ids)]
+        snapshot = self.transport.measure()
+        try:
+            found = start.find_successor(id)
+        except (OSError, RemoteError):
+            self.lookups['failed'] += 1
+            return
+        messages, elapsed = self.transport.cost(snapshot)
+        if found == self.owner(id):
+            self.lookups['correct'] += 1
+        else:
+            self.lookups['wrong' if found in self.transport.nodes else 'dead'] += 1
+        self.lookups['hops'].append(messages['closest_preceding_finger'])
+        self.lookups['messages'].append(sum(messages.values()))
+        self.lookups['latency'].append(elapsed)
+
+    def run_lookups(self, count):
+        for i in range(count):
+            self.lookup()
+        return self.lookups
+
+    '''
+        Poisson arrivals of joins, failures and lookups over duration virtual seconds,
+        with every node's maintenance running in between'''
+    def churn(self, duration, joins, failures, lookups):
+        for count, event in ((joins, self.join), (failures, self.fail), (lookups, self.lookup)):
+            t = 0.0
+            for i in range(count):
+                t += self.rng.expovariate(count / duration)
+                heapq.heappush(self.events, (t + self.now, next(self.seq), event, ()))
+        self.run(self.now + duration)
+
+    '''
+        Keys held per physical node against the mean
+        @:return: dict'''
+    def key_balance(self):
+        keys = Counter()
+        for n in self.ids:
+            keys[self.hosts[n]] += len(self.transport.nodes[n].keys)
+        counts = [keys[host] for host in set(self.hosts[n] for n in self.ids)]
+        mean = sum(counts) / len(counts)
+        balance = summary(counts)
+        balance['max/mean'] = balance['max'] / mean if mean else None
+        balance['empty'] = counts.count(0)
+        return balance
+
+    def report(self):
+        hops = Counter(self.lookups['hops'])
+        live = len(set(self.hosts[n] for n in self.ids))
+        return {
+            'bits': self.bits,
+            'nodes': live,
+            'ring_ids': len(self.ids),
+            'virtual_seconds': self.now,
+            'lookups': {
+                'correct': self.lookups['correct'],
+                'wrong': self.lookups['wrong'],
+                'dead': self.lookups['dead'],
+                'failed': self.lookups['failed'],
+                'hops': summary(self.lookups['hops']),
+                'hop_histogram': {str(h): hops[h] for h in sorted(hops)},
+                'messages': summary(self.lookups['messages']),
+                'latency_ms': summary([t * 1000 for t in self.lookups['latency']]),
+            },
+            'joins': {
+                'count': len(self.joins['messages']),
+                'failed': self.joins['failed'],
+                'messages': summary(self.joins['messages']),
+                'latency_ms': summary([t * 1000 for t in self.joins['latency']]),
+                'messages_by_method': dict(self.joins['by_method'].most_common()),
+            },
+            'failures': self.failures,
+            'maintenance': {
+                'messages': sum(self.maintenance.values()),
+                'per_node_second': sum(self.maintenance.values()) / max(len(self.ids) * self.now, 1e-9),
+                'failed_rounds': self.maintenance_failed,
+            },
+            'keys': self.key_balance(),
+        }
+
+
+'''
+    Main method: builds a ring of --nodes nodes with --bits bit ids, loads --keys keys (10 per node by default)
+    and runs --lookups lookups on it; with --duration > 0 the lookups are spread over that many virtual seconds
+    together with --joins joins and --failures crashes, every node stabilizing as it would for real
+    --vnodes : ids per physical node, key balance is reported per physical node
+    --latency MIN MAX : one-way message delay in milliseconds'''
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage='python chord_sim.py [--nodes N] [--bits M] [--vnodes V] [--keys K] '
+                                           '[--lookups L] [--joins J] [--failures F] [--duration S] '
+                                           '[--latency MIN MAX] [--stabilize-interval S] [--fix-fingers-interval S] '
+                                           '[--check-predecessor-interval S] [--seed N] [--json]')
+    parser.add_argument('--nodes', type=int, default=NODES)
+    parser.add_argument('--bits', type=int, default=BITS)
+    parser.add_argument('--vnodes', type=int, default=1)
+    parser.add_argument('--keys', type=int)
+    parser.add_argument('--lookups', type=int, default=1000)
+    parser.add_argument('--joins', type=int, default=0)
+    parser.add_argument('--failures', type=int, default=0)
+    parser.add_argument('--duration', type=float, default=0)
+    parser.add_argument('--latency', type=float, nargs=2, default=[t * 1000 for t in LATENCY])
+    parser.add_argument('--stabilize-interval', type=float, default=STABILIZE_INTERVAL)
+    parser.add_argument('--fix-fingers-interval', type=float, default=FIX_FINGERS_INTERVAL)
+    parser.add_argument('--check-predecessor-interval', type=float, default=CHECK_PREDECESSOR_INTERVAL)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+    if (args.joins or args.failures) and args.duration <= 0:
+        parser.error('--joins and --failures need --duration')
+    started = time.perf_counter()
+    sim = Simulator(args.bits, tuple(t / 1000 for t in args.latency), args.seed, args.vnodes,
+                    args.stabilize_interval, args.fix_fingers_interval, args.check_predecessor_interval)
+    sim.build(args.nodes)
+    sim.load_keys(10 * args.nodes if args.keys is None else args.keys)
+    if args.duration > 0:
+        sim.churn(args.duration, args.joins, args.failures, args.lookups)
+    else:
+        sim.run_lookups(args.lookups)
+    report = sim.report()
+    report['wall_seconds'] = time.perf_counter() - started
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report)
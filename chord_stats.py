@@ -0,0 +1,359 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from chord_ring import RingCache
+from chord_rpc import DIRECTORY, POOL
+
+PERCENTILES = (50, 95, 99)  # percentiles every summary reports
+SAMPLE_INTERVAL = 0.01  # seconds between profiler samples
+SAMPLE_DEPTH = 8  # innermost frames kept per sampled stack
+# innermost frames of threads that are only waiting for work, left out of profiles
+IDLE_FRAMES = {('threading.py', 'wait'), ('selectors.py', 'select'), ('socket.py', 'accept'),
+               ('queue.py', 'get'), ('thread.py', '_worker'), ('threading.py', '_wait_for_tstate_lock'),
+               ('threading.py', 'join'), ('chord_node.py', 'maintain')}
+POLL_INTERVAL = 5.0  # seconds between polls of the ring
+
+
+'''
+    Value at percentile p of a sorted list, nearest rank
+    @:return: number, None for an empty list'''
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered) + 0.5)) - 1))]
+
+
+'''
+    Count, mean, percentiles and maximum of a list of numbers
+    >>> summary([3, 1, 2, 4])
+    {'count': 4, 'mean': 2.5, 'p50': 2, 'p95': 4, 'p99': 4, 'max': 4}
+    @:return: dict'''
+def summary(values):
+    ordered = sorted(values)
+    result = {'count': len(ordered), 'mean': sum(ordered) / len(ordered) if ordered else None}
+    for p in PERCENTILES:
+        result['p{}'.format(p)] = percentile(ordered, p)
+    result['max'] = ordered[-1] if ordered else None
+    return result
+
+
+'''
+    Prints a nested report dict as indented text, floats rounded to 3 places'''
+def print_report(report, out=sys.stdout):
+    def walk(value, indent):
+        for key, item in value.items():
+            if isinstance(item, dict):
+                print('{}{}:'.format(' ' * indent, key), file=out)
+                walk(item, indent + 2)
+            else:
+                if isinstance(item, float):
+                    item = round(item, 3)
+                print('{}{}: {}'.format(' ' * indent, key, item), file=out)
+    walk(report, 0)
+
+
+class Histogram(object):
+    """
+    Latency histogram over whole microseconds: exact below 16us, above that eight buckets per
+    power of two, so a percentile is off by at most 1/8 of its value.
+
+    Adding a sample is one int conversion and one dict update, cheap enough to do for every rpc.
+    Histograms subtract, which turns two cumulative snapshots into the latencies between them.
+
+    >>> h = Histogram()
+    >>> for us in range(1, 1001):
+    ...     h.add(us / 1e6)
+    >>> h.percentile(50) * 1e6, h.percentile(99) * 1e6, h.count
+    (512.0, 1024.0, 1000)
+    >>> (h - h).count, Histogram.from_dict(h.to_dict()).percentile(50) == h.percentile(50)
+    (0, True)
+    """
+
+    def __init__(self, buckets=None, count=0, total=0.0):
+        self.buckets = dict(buckets or {})  # bucket index -> samples
+        self.count = count
+        self.total = total  # seconds
+
+    def add(self, seconds):
+        us = int(seconds * 1e6)
+        if us >= 16:
+            shift = us.bit_length() - 4
+            us = shift * 8 + (us >> shift)
+        self.buckets[us] = self.buckets.get(us, 0) + 1
+        self.count += 1
+        self.total += seconds
+
+    @staticmethod
+    def upper(index):
+        """ Upper bound of a bucket in microseconds """
+        if index < 16:
+            return index + 1
+        shift = index // 8 - 1
+        return (index % 8 + 9) << shift
+
+    def percentile(self, p):
+        """ Upper bound of the bucket holding percentile p, in seconds, None when empty """
+        if self.count <= 0:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return self.upper(index) / 1e6
+        return self.upper(max(self.buckets)) / 1e6
+
+    def __sub__(self, other):
+        buckets = {index: n - other.buckets.get(index, 0) for index, n in self.buckets.items()}
+        return Histogram({index: n for index, n in buckets.items() if n > 0},
+                         self.count - other.count, self.total - other.total)
+
+    def __add__(self, other):
+        buckets = dict(self.buckets)
+        for index, n in other.buckets.items():
+            buckets[index] = buckets.get(index, 0) + n
+        return Histogram(buckets, self.count + other.count, self.total + other.total)
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.total, 'buckets': dict(self.buckets)}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['buckets'], d['count'], d['sum'])
+
+    def summary(self):
+        """ count, mean and percentiles in milliseconds """
+        result = {'count': self.count, 'mean_ms': self.total / self.count * 1000 if self.count > 0 else None}
+        for p in PERCENTILES:
+            value = self.percentile(p)
+            result['p{}_ms'.format(p)] = value * 1000 if value is not None else None
+        return result
+
+
+class RpcStats(object):
+    """
+    Counters for the rpcs one side of a connection handles: calls, errors, bytes in and out and
+    a latency Histogram per method, plus named event counters and lookup hop counts.
+
+    Everything is updated under one lock held for a few dict operations, so recording costs
+    about as much as a couple of Python function calls, small next to decoding and answering the rpc.
+
+    >>> stats = RpcStats()
+    >>> stats.record('successor', 0.0002, 10, 12)
+    >>> stats.record('successor', 0.0004, 10, 12, error=True)
+    >>> stats.hop(2)
+    >>> d = stats.to_dict()
+    >>> d['methods']['successor']['calls'], d['methods']['successor']['errors'], d['hops']
+    (2, 1, {2: 1})
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.methods = {}  # method -> [calls, errors, bytes in, bytes out, Histogram]
+        self.counters = Counter()  # event name -> times it happened
+        self.hops = Counter()  # rpcs an iterative lookup made -> lookups
+
+    def record(self, method, seconds, bytes_in, bytes_out, error=False):
+        with self.lock:
+            entry = self.methods.get(method)
+            if entry is None:
+                entry = self.methods[method] = [0, 0, 0, 0, Histogram()]
+            entry[0] += 1
+            entry[1] += error
+            entry[2] += bytes_in
+            entry[3] += bytes_out
+            entry[4].add(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def hop(self, hops):
+        with self.lock:
+            self.hops[hops] += 1
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'since': self.started,
+                'methods': {method: {'calls': calls, 'errors': errors, 'bytes_in': bytes_in,
+                                     'bytes_out': bytes_out, 'latency': histogram.to_dict()}
+                            for method, (calls, errors, bytes_in, bytes_out, histogram) in self.methods.items()},
+                'counters': dict(self.counters),
+                'hops': dict(self.hops),
+            }
+
+
+class Sampler(object):
+    """
+    Sampling profiler: a daemon thread that every interval seconds notes the innermost
+    depth frames of every other thread, leaving out threads that are idle waiting for work.
+
+    The cost is one sys._current_frames() walk per interval whatever the request rate,
+    so it can be left running on a loaded node; top() shows where the busy threads are.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL, depth=SAMPLE_DEPTH):
+        self.interval = interval
+        self.depth = depth
+        self.lock = threading.Lock()
+        self.samples = Counter()  # 'file:function:line < caller < ...' -> times seen
+        self.rounds = 0
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def run(self):
+        me = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.depth:
+                    code = frame.f_code
+                    stack.append('{}:{}:{}'.format(os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+                    frame = frame.f_back
+                stacks.append(' < '.join(stack))
+            with self.lock:
+                self.samples.update(stacks)
+                self.rounds += 1
+
+    def top(self, n):
+        """ The n stacks seen most often, as [[samples, stack], ...] """
+        with self.lock:
+            return {'rounds': self.rounds, 'stacks': [[count, stack] for stack, count in self.samples.most_common(n)]}
+
+
+'''
+    Polls the stats rpc of every process in the ring once
+    Param 1: port of existing node
+    @:return: {port: stats}, processes that did not answer are left out'''
+def poll_ring(existing_port, ring, profile=0):
+    ring.refresh(existing_port, None)
+    ports = sorted(set(DIRECTORY.port(n) for n in ring.nodes))
+    result = {}
+    for port in ports:
+        try:
+            result[port] = POOL.call(port, 'stats', profile)
+        except OSError:
+            pass
+    return result
+
+
+'''
+    Per-process and per-method rows for one poll, rates and percentiles over the time since previous
+    (the process's whole life when there is no previous poll)
+    @:return: (process rows, method rows)'''
+def ring_rows(current, previous=None):
+    previous = previous or {}
+    nodes = []
+    methods = {}
+    for port, stats in sorted(current.items()):
+        before = previous.get(port)
+        if before is not None and before['served']['since'] != stats['served']['since']:
+            before = None  # restarted in between
+        seconds = max(stats['time'] - (before['time'] if before else stats['served']['since']), 1e-9)
+        total = Histogram()
+        calls = errors = bytes_in = bytes_out = 0
+        for method, entry in stats['served']['methods'].items():
+            old = before['served']['methods'].get(method) if before else None
+            histogram = Histogram.from_dict(entry['latency'])
+            if old is not None:
+                histogram = histogram - Histogram.from_dict(old['latency'])
+            delta = {key: entry[key] - (old[key] if old else 0) for key in ('calls', 'errors', 'bytes_in', 'bytes_out')}
+            calls += delta['calls']
+            errors += delta['errors']
+            bytes_in += delta['bytes_in']
+            bytes_out += delta['bytes_out']
+            total = total + histogram
+            row = methods.setdefault(method, [0, 0, Histogram(), 0.0])
+            row[0] += delta['calls']
+            row[1] += delta['errors']
+            row[2] = row[2] + histogram
+            row[3] = max(row[3], seconds)
+        latency = total.summary()
+        nodes.append({'port': port, 'ids': stats['ids'], 'keys': stats['keys'], 'rpc_per_sec': calls / seconds,
+                      'errors': errors, 'p50_ms': latency['p50_ms'], 'p99_ms': latency['p99_ms'],
+                      'kb_in_per_sec': bytes_in / seconds / 1e3, 'kb_out_per_sec': bytes_out / seconds / 1e3,
+                      'connections': stats['connections']['open'], 'threads': stats['threads']})
+    rows = []
+    for method, (calls, errors, histogram, seconds) in sorted(methods.items(), key=lambda item: -item[1][0]):
+        if not calls:
+            continue
+        latency = histogram.summary()
+        rows.append({'method': method, 'calls_per_sec': calls / seconds, 'errors': errors,
+                     'p50_ms': latency['p50_ms'], 'p95_ms': latency['p95_ms'], 'p99_ms': latency['p99_ms']})
+    return nodes, rows
+
+
+def ms(value):
+    return '{:.2f}'.format(value) if value is not None else '-'
+
+
+def print_rows(nodes, methods, out=sys.stdout):
+    print('{:>6} {:>12} {:>8} {:>9} {:>6} {:>8} {:>8} {:>9} {:>9} {:>6} {:>7}'.format(
+        'port', 'ids', 'keys', 'rpc/s', 'errors', 'p50 ms', 'p99 ms', 'KB/s in', 'KB/s out', 'conns', 'threads'),
+        file=out)
+    for row in nodes:
+        print('{:>6} {:>12} {:>8} {:>9.1f} {:>6} {:>8} {:>8} {:>9.1f} {:>9.1f} {:>6} {:>7}'.format(
+            row['port'], ','.join(map(str, row['ids'])), row['keys'], row['rpc_per_sec'], row['errors'],
+            ms(row['p50_ms']), ms(row['p99_ms']), row['kb_in_per_sec'], row['kb_out_per_sec'],
+            row['connections'], row['threads']), file=out)
+    print('{:>26} {:>9} {:>6} {:>8} {:>8} {:>8}'.format('method', 'calls/s', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'),
+          file=out)
+    for row in methods:
+        print('{:>26} {:>9.1f} {:>6} {:>8} {:>8} {:>8}'.format(
+            row['method'], row['calls_per_sec'], row['errors'], ms(row['p50_ms']), ms(row['p95_ms']),
+            ms(row['p99_ms'])), file=out)
+
+
+'''
+    Main method: requires one argument, the port of a node in the ring
+    Polls the stats rpc of every process in the ring and prints one row per process and one per rpc method;
+    the first poll covers each process's whole life, later ones the interval since the poll before
+    --interval S : seconds between polls, --count N : stop after N polls (0 = until interrupted)
+    --profile N : also print the N stacks each process's sampling profiler saw most
+    (nodes started with --profile-interval)
+    --json : print every poll's raw stats as one JSON object per line instead'''
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage='python chord_stats.py EXISTINGNODE_PORT [--interval S] [--count N] '
+                                           '[--profile N] [--json]')
+    parser.add_argument('existing_node_port', type=int)
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL)
+    parser.add_argument('--count', type=int, default=1)
+    parser.add_argument('--profile', type=int, default=0)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+    ring = RingCache()
+    previous = None
+    for i in itertools.count(1):
+        current = poll_ring(args.existing_node_port, ring, args.profile)
+        if args.json:
+            print(json.dumps({str(port): stats for port, stats in current.items()}))
+        else:
+            print_rows(*ring_rows(current, previous))
+            for port, stats in sorted(current.items()):
+                profile = stats.get('profile')
+                if profile:
+                    print('profile of {}, {} samples:'.format(port, profile['rounds']))
+                    for count, stack in profile['stacks']:
+                        print('{:>7} {}'.format(count, stack))
+            print()
+        sys.stdout.flush()
+        if i == args.count:
+            break
+        previous = current
+        time.sleep(args.interval)
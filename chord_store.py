@@ -0,0 +1,830 @@
+import itertools
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import partial
+
+from chord_codec import bytes_header, decode, encode, value_extent
+
+LOG_RECORD = struct.Struct('!IBHI')  # crc32 of everything after it, op, key size, value size
+PUT, DELETE = 1, 2
+SNAPSHOT_MAGIC = b'CHORDSN1'
+SNAPSHOT_FOOTER = struct.Struct('!8sQQH')  # magic, index offset, key count, key width
+FSYNC_MODES = ('always', 'batch', 'none')
+FSYNC_INTERVAL = 0.05  # seconds between fsyncs of the log in batch mode
+SNAPSHOT_BYTES = 64 << 20  # log size that triggers a compacted snapshot
+CACHE_SIZE = 10000  # entries a ValueCache holds before evicting the least recently used
+COPY_CHUNK = 1 << 20  # bytes moved at a time when a large value is copied between files
+BUCKET_SIZE = 1000  # keys per bucket of a SortedKeys index, a bucket is split at twice that
+
+
+class SortedKeys(object):
+    """
+    Sorted keys kept as a list of sorted buckets of up to 2 * BUCKET_SIZE keys, with the largest key of each.
+
+    Adding or removing a key shifts the keys of one bucket rather than of the whole index, and
+    cutting out the keys in [lo, hi) slices the two buckets at its ends and drops the ones in
+    between whole, so it costs O(log n + k + n / BUCKET_SIZE) for k keys removed.
+
+    >>> sk = SortedKeys()
+    >>> for key in [5, 1, 9, 3, 7]:
+    ...     sk.insert(key)
+    >>> list(sk), sk.irange(2, 8), sk.irange(2, 8, 2)
+    ([1, 3, 5, 7, 9], [3, 5, 7], [3, 5])
+    >>> sk.remove(5)
+    >>> sk.cut(0, 4), list(sk), len(sk), sk.last()
+    ([1, 3], [7, 9], 2, 9)
+    >>> sk.update([8, 2]); list(sk)
+    [2, 7, 8, 9]
+    """
+
+    def __init__(self, keys=()):
+        """ keys must be sorted already """
+        self.build(list(keys))
+
+    def build(self, keys):
+        self.buckets = [keys[i:i + BUCKET_SIZE] for i in range(0, len(keys), BUCKET_SIZE)]
+        self.maxes = [bucket[-1] for bucket in self.buckets]
+        self.size = len(keys)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.buckets)
+
+    def last(self):
+        return self.maxes[-1]
+
+    def insert(self, key):
+        """ Adds a key not in the index """
+        i = bisect_left(self.maxes, key)
+        if i == len(self.maxes):
+            if not self.buckets:
+                self.buckets.append([])
+                self.maxes.append(key)
+            i = len(self.maxes) - 1
+        bucket = self.buckets[i]
+        bucket.insert(bisect_left(bucket, key), key)
+        self.size += 1
+        self.fix(i)
+
+    def update(self, keys):
+        """ Adds keys not in the index, many at once are merged in with one sort """
+        if len(keys) * 8 > self.size:
+            self.build(sorted(itertools.chain(self, keys)))
+        else:
+            for key in keys:
+                self.insert(key)
+
+    def remove(self, key):
+        """ Drops a key in the index """
+        i = bisect_left(self.maxes, key)
+        bucket = self.buckets[i]
+        del bucket[bisect_left(bucket, key)]
+        self.size -= 1
+        self.fix(i)
+
+    def irange(self, lo, hi, limit=None):
+        """ The keys in [lo, hi), at most limit of them from lo on """
+        i = bisect_left(self.maxes, lo)
+        if i == len(self.maxes):
+            return []
+        j = bisect_left(self.buckets[i], lo)
+        keys = []
+        for bucket in itertools.islice(self.buckets, i, None):
+            k = bisect_left(bucket, hi, j)
+            keys.extend(bucket[j:k])
+            if k < len(bucket) or (limit is not None and len(keys) >= limit):
+                break
+            j = 0
+        return keys if limit is None else keys[:limit]
+
+    def cut(self, lo, hi):
+        """ Removes the keys in [lo, hi) and returns them """
+        i = bisect_left(self.maxes, lo)
+        if i == len(self.maxes):
+            return []
+        j = bisect_left(self.maxes, hi, i)  # the first bucket reaching hi, where the cut ends
+        first = self.buckets[i]
+        a = bisect_left(first, lo)
+        if j == i:
+            b = bisect_left(first, hi, a)
+            keys = first[a:b]
+            del first[a:b]
+        else:
+            keys = first[a:]
+            del first[a:]
+            for bucket in self.buckets[i + 1:j]:
+                keys.extend(bucket)
+            del self.buckets[i + 1:j]
+            del self.maxes[i + 1:j]
+            if i + 1 < len(self.buckets):
+                last = self.buckets[i + 1]
+                b = bisect_left(last, hi)
+                keys.extend(last[:b])
+                del last[:b]
+                self.fix(i + 1)
+        self.size -= len(keys)
+        self.fix(i)
+        return keys
+
+    def fix(self, i):
+        """ Brings bucket i back to between BUCKET_SIZE / 2 and 2 * BUCKET_SIZE keys, where it can """
+        if i >= len(self.buckets):
+            return
+        bucket = self.buckets[i]
+        if len(bucket) < BUCKET_SIZE // 2 and i + 1 < len(self.buckets):
+            bucket.extend(self.buckets.pop(i + 1))
+            del self.maxes[i + 1]
+        if not bucket:
+            del self.buckets[i]
+            del self.maxes[i]
+        elif len(bucket) > 2 * BUCKET_SIZE:
+            half = len(bucket) // 2
+            self.buckets[i:i + 1] = [bucket[:half], bucket[half:]]
+            self.maxes[i:i + 1] = [bucket[half - 1], bucket[-1]]
+        else:
+            self.maxes[i] = bucket[-1]
+
+
+class KeyStore(object):
+    """
+    Node-local key: value storage with a sorted index over the integer keys.
+
+    Lookups go through a dict; the SortedKeys index lets a wrapping identifier interval
+    be read or cut out by walking only the keys in it instead of every id in the interval.
+
+    >>> ks = KeyStore()
+    >>> ks.update({6: 'f', 1: 'a', 7: 'g', 3: 'c'})
+    >>> 3 in ks, ks[7], len(ks)
+    (True, 'g', 4)
+    >>> ks.range_items(6, 2, 8)
+    [(6, 'f'), (7, 'g'), (1, 'a')]
+    >>> ks.pop_range(6, 2, 8)
+    {6: 'f', 7: 'g', 1: 'a'}
+    >>> ks
+    {3: 'c'}
+    >>> ks.update({6: 'f', 1: 'a', 7: 'g'})
+    >>> ks.range_chunk(6, 2, 8, 2)
+    ([(6, 'f'), (7, 'g')], 0)
+    >>> ks.range_chunk(0, 2, 8, 2)
+    ([(1, 'a')], None)
+    """
+
+    def __init__(self, items=None):
+        self.data = {}
+        self.index = SortedKeys()  # sorted keys of self.data
+        if items:
+            self.update(items)
+
+    def __repr__(self):
+        return repr({key: self.data[key] for key in self.index})
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        if key not in self.data:
+            self.index.insert(key)
+        self.data[key] = value
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(list(self.index))
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def items(self):
+        return [(key, self.data[key]) for key in self.index]
+
+    def update(self, items):
+        """ Store every pair of a dict """
+        if not isinstance(items, dict):
+            items = dict(items)
+        new_keys = [key for key in items if key not in self.data]
+        self.data.update(items)
+        self.index.update(new_keys)
+
+    def sync(self):
+        """ Waits until the writes made so far are durable, nothing to wait for in memory """
+
+    def delete(self, keys):
+        for key in keys:
+            if key in self.data:
+                del self.data[key]
+                self.index.remove(key)
+
+    def intervals(self, start, stop, divisor):
+        """ [lo, hi) key intervals covering ModRange(start, stop, divisor), i.e. [start, stop) wrapping at divisor """
+        start, stop = start % divisor, stop % divisor
+        if start < stop:
+            return ((start, stop),)
+        return ((start, divisor), (0, stop))
+
+    def range_items(self, start, stop, divisor):
+        """ (key, value) pairs with key in ModRange(start, stop, divisor), in ring order from start """
+        return [(key, self.data[key]) for key in self.range_keys(start, stop, divisor)]
+
+    def range_chunk(self, start, stop, divisor, limit):
+        """
+        At most limit (key, value) pairs from the front of ModRange(start, stop, divisor), and the
+        start of what is left of the range, None once it is exhausted; passing that back as start
+        walks the range chunk by chunk without ever materialising all of it
+        """
+        chunk = []
+        for lo, hi in self.intervals(start, stop, divisor):
+            for key in self.index.irange(lo, hi, limit - len(chunk)):
+                chunk.append((key, self[key]))
+            if len(chunk) == limit:
+                rest = (chunk[-1][0] + 1) % divisor
+                return chunk, None if rest == stop % divisor else rest
+        return chunk, None
+
+    def range_keys(self, start, stop, divisor):
+        return [key for lo, hi in self.intervals(start, stop, divisor) for key in self.index.irange(lo, hi)]
+
+    def delete_range(self, start, stop, divisor):
+        """ Remove every key in ModRange(start, stop, divisor) without reading the values """
+        for lo, hi in self.intervals(start, stop, divisor):
+            for key in self.index.cut(lo, hi):
+                del self.data[key]
+
+    def pop_range(self, start, stop, divisor):
+        """ Remove and return every key in ModRange(start, stop, divisor) as a dict """
+        response = {}
+        for lo, hi in self.intervals(start, stop, divisor):
+            for key in self.index.cut(lo, hi):
+                response[key] = self.data.pop(key)
+        return response
+
+    def value_range(self, key, offset, length):
+        """
+        Up to length bytes of a bytes or str value (str as utf-8) from offset on, with the
+        value's full size, as (size, piece); None if key is absent. Bytes are sliced, not copied
+        """
+        value = self.get(key)
+        if value is None:
+            return None
+        if isinstance(value, str):
+            value = value.encode()
+        elif not isinstance(value, (bytes, bytearray, memoryview)):
+            raise TypeError('value of {} is not bytes or str'.format(key))
+        return len(value), memoryview(value)[offset:offset + length]
+
+    def blob_writer(self, key, size):
+        """ A BlobBuffer to write a value of size bytes into piece by piece, stored with update({key: writer.value()}) """
+        return BlobBuffer(size)
+
+
+class BlobBuffer(object):
+    """
+    A bytes value of known size written in order, piece by piece, so a large value never
+    has to arrive in one message. Here the pieces go straight into one preallocated bytearray,
+    which value() hands over to be stored as it is.
+
+    >>> blob = KeyStore().blob_writer(5, 5)
+    >>> blob.write(0, b'abc'); blob.write(3, memoryview(b'de')); blob.complete
+    True
+    >>> ks = KeyStore({5: blob.value()}); ks.value_range(5, 1, 3)[0], bytes(ks.value_range(5, 1, 3)[1])
+    (5, b'bcd')
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.received = 0
+        self.buffer = bytearray(size)
+
+    @property
+    def complete(self):
+        return self.received == self.size
+
+    def check(self, offset, data):
+        if offset != self.received or offset + len(data) > self.size:
+            raise ValueError('piece at {} of {} bytes does not continue {} of {} bytes'.format(
+                offset, len(data), self.received, self.size))
+
+    def write(self, offset, data):
+        self.check(offset, data)
+        self.buffer[offset:offset + len(data)] = data
+        self.received += len(data)
+
+    def value(self):
+        return self.buffer
+
+    def discard(self):
+        self.buffer = None
+
+
+class _OnDisk(object):
+    """ Where a stored value lives: read(offset, size) returns its encoded bytes """
+    __slots__ = ('read', 'offset', 'size')
+
+    def __init__(self, read, offset, size):
+        self.read, self.offset, self.size = read, offset, size
+
+    def raw(self):
+        return self.read(self.offset, self.size)
+
+    def pieces(self, size=COPY_CHUNK):
+        for start in range(0, self.size, size):
+            yield self.read(self.offset + start, min(size, self.size - start))
+
+
+'''
+    A log record up to its value: everything the crc covers except the encoded value itself
+    @:return: bytes'''
+def _record_head(op, key, value_size):
+    kb = key.to_bytes((key.bit_length() + 7) // 8 or 1, 'big')
+    return LOG_RECORD.pack(0, op, len(kb), value_size)[4:] + kb
+
+
+class _StagedBlob(BlobBuffer):
+    """
+    BlobBuffer of a DurableKeyStore: the pieces go to a file in the staging directory, laid out
+    as the complete PUT log record of the value, so storing it is a plain copy onto the log
+    and memory use does not grow with the value. value() does that copy, before the caller
+    takes its own locks to update the store, and returns where the value ended up.
+    """
+
+    def __init__(self, store, key, size):
+        self.store = store
+        self.size = size
+        self.received = 0
+        header = bytes_header(size)
+        head = _record_head(PUT, key, len(header) + size) + header
+        self.value_offset = len(head) + 4 - len(header)  # where the encoded value starts in the record
+        self.value_size = len(header) + size
+        self.crc = zlib.crc32(head)
+        self.name = os.path.join(store.staging, '{}.{}'.format(key, next(store.staged_ids)))
+        self.file = open(self.name, 'w+b')
+        self.file.write(bytes(4) + head)
+
+    def write(self, offset, data):
+        self.check(offset, data)
+        self.file.write(data)
+        self.crc = zlib.crc32(data, self.crc)
+        self.received += len(data)
+
+    def value(self):
+        self.file.seek(0)
+        self.file.write(struct.pack('!I', self.crc))
+        self.file.flush()
+        store = self.store
+        with store.file_lock:
+            offset = store.append_file(self.file)
+            store.pending += 1  # no compaction until update() has the value indexed
+            read = store.read_log
+        self.discard()
+        return _OnDisk(read, offset + self.value_offset, self.value_size)
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.unlink(self.name)
+        except FileNotFoundError:
+            pass
+
+
+'''
+    Reads size bytes at offset from an open file; bound to one file with partial, so a value
+    keeps reading the log it was written to after the store has moved on to a new one'''
+def _pread(f, offset, size):
+    return os.pread(f.fileno(), size, offset)
+
+
+def _slice(buf, offset, size):
+    return buf[offset:offset + size]
+
+
+class DurableKeyStore(KeyStore):
+    """
+    KeyStore persisted in a directory as a compacted snapshot plus an append-only log.
+
+    Every update and delete is appended to the log as a crc-checked record; once the
+    log passes snapshot_bytes the live keys are written out as a new snapshot and the
+    log starts over. The snapshot ends with a sorted fixed-width index of
+    (key, offset, size) that is memory-mapped on start, so a restart only parses the
+    index and replays the log; values stay on disk and are decoded when read.
+
+    Writes only reach the OS page cache; sync() makes them durable as fsync asks and is meant to
+    be called once the caller has let go of its own locks, so that no reader waits on the disk:
+    'always' - sync() returns once the records written so far are on disk. Writers calling it
+               together share one fsync (group commit), so the cost is per round, not per write.
+    'batch'  - sync() returns at once and a background thread syncs the log every FSYNC_INTERVAL:
+               a crash can lose the writes of the last FSYNC_INTERVAL, even though they were acknowledged.
+    'none'   - left to the OS.
+    Compaction runs on its own thread, writes carry on meanwhile into a fresh log.
+    """
+
+    def __init__(self, path, fsync='batch', snapshot_bytes=SNAPSHOT_BYTES):
+        if fsync not in FSYNC_MODES:
+            raise ValueError('fsync must be one of {}'.format(FSYNC_MODES))
+        super().__init__()
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.fsync = fsync
+        self.snapshot_bytes = snapshot_bytes
+        self.file_lock = threading.Lock()  # guards the log and every change to data and index
+        self.sync_lock = threading.Lock()  # held by the writer running the fsync of a group commit
+        self.staging = os.path.join(path, 'staging')  # values being streamed in, see blob_writer
+        os.makedirs(self.staging, exist_ok=True)
+        for name in os.listdir(self.staging):  # left over from a crash part way through an upload
+            os.unlink(os.path.join(self.staging, name))
+        self.staged_ids = itertools.count()
+        self.pending = 0  # streamed values appended to the log but not yet indexed
+        self.compacting = False
+        self.snapshot = None
+        self.load_snapshot()
+        interrupted = os.path.exists(self.log_name('compacting'))
+        if interrupted:  # its records may or may not be in the snapshot already, replaying them twice is harmless
+            self.replay_log(open(self.log_name('compacting'), 'rb'))
+        self.log = open(self.log_name(), 'a+b')
+        self.read_log = partial(_pread, self.log)
+        self.replay_log(self.log)
+        self.log_size = self.log.seek(0, os.SEEK_END)
+        self.appended = self.synced = 0  # bytes ever appended to the log, and how many of them are on disk
+        if interrupted:
+            self.compacting = True
+            self.compact()
+        if fsync == 'batch':
+            threading.Thread(target=self.sync_loop, daemon=True).start()
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __getitem__(self, key):
+        return self.load(self.data[key])
+
+    def get(self, key, default=None):
+        stored = self.data.get(key, default)
+        return default if stored is default else self.load(stored)
+
+    def items(self):
+        return [(key, self.load(self.data[key])) for key in self.index]
+
+    def range_items(self, start, stop, divisor):
+        return [(key, self.load(stored)) for key, stored in super().range_items(start, stop, divisor)]
+
+    def load(self, stored):
+        return decode(stored.raw()) if type(stored) is _OnDisk else stored
+
+    def log_name(self, suffix=None):
+        return os.path.join(self.path, 'log' if suffix is None else 'log.' + suffix)
+
+    def update(self, items):
+        """
+        Appends a PUT record per pair and keeps only the record's position in memory
+        values from blob_writer(...).value() are in the log already and only get indexed
+        """
+        if not isinstance(items, dict):
+            items = dict(items)
+        refs = {key: value for key, value in items.items() if type(value) is _OnDisk}
+        keys = []
+        records = []
+        sizes = []
+        for key, value in items.items():
+            if key not in refs:
+                raw = encode(value)
+                keys.append(key)
+                records.append(self.record(PUT, key, raw))
+                sizes.append(len(raw))
+        with self.file_lock:
+            offset = self.append(b''.join(records))
+            for key, record, size in zip(keys, records, sizes):
+                offset += len(record)
+                refs[key] = _OnDisk(self.read_log, offset - size, size)
+            super().update(refs)
+            self.pending -= len(refs) - len(keys)
+
+    def value_range(self, key, offset, length):
+        """ KeyStore.value_range reading only the piece asked for, not the whole value """
+        stored = self.data.get(key)
+        extent = value_extent(stored.read(stored.offset, min(stored.size, 5))) if type(stored) is _OnDisk else None
+        if extent is None:
+            return super().value_range(key, offset, length)
+        size, header = extent
+        return size, stored.read(stored.offset + header + offset, max(0, min(length, size - offset)))
+
+    def blob_writer(self, key, size):
+        return _StagedBlob(self, key, size)
+
+    def delete(self, keys):
+        keys = [key for key in keys if key in self.data]
+        with self.file_lock:
+            self.append(b''.join(self.record(DELETE, key, b'') for key in keys))
+            super().delete(keys)
+
+    def pop_range(self, start, stop, divisor):
+        with self.file_lock:
+            moved = super().pop_range(start, stop, divisor)
+            self.append(b''.join(self.record(DELETE, key, b'') for key in moved))
+        return {key: self.load(stored) for key, stored in moved.items()}
+
+    def delete_range(self, start, stop, divisor):
+        with self.file_lock:
+            keys = self.range_keys(start, stop, divisor)
+            self.append(b''.join(self.record(DELETE, key, b'') for key in keys))
+            super().delete_range(start, stop, divisor)
+
+    def record(self, op, key, raw):
+        body = _record_head(op, key, len(raw)) + raw
+        return struct.pack('!I', zlib.crc32(body)) + body
+
+    def append(self, data):
+        """ Writes records at the end of the log, returns the offset they start at; needs file_lock """
+        offset = self.log_size
+        if data:
+            self.log.seek(0, os.SEEK_END)
+            self.log.write(data)
+            self.flush_log()
+        return offset
+
+    def append_file(self, f):
+        """ append for records in a file, copied COPY_CHUNK bytes at a time; needs file_lock """
+        offset = self.log_size
+        self.log.seek(0, os.SEEK_END)
+        buffer = bytearray(COPY_CHUNK)
+        view = memoryview(buffer)
+        f.seek(0)
+        n = f.readinto(buffer)
+        while n:
+            self.log.write(view[:n])
+            n = f.readinto(buffer)
+        self.flush_log()
+        return offset
+
+    def flush_log(self):
+        """ Hands what append wrote to the OS; needs file_lock """
+        self.log.flush()
+        end = self.log.tell()
+        self.appended += end - self.log_size
+        self.log_size = end
+
+    def sync(self):
+        """
+        Waits until the records written so far are as durable as fsync asks, see the class docstring,
+        and starts a compaction once the log has passed snapshot_bytes
+        """
+        if self.fsync == 'always':
+            target = self.appended
+            with self.sync_lock:  # whoever gets it first syncs for everyone waiting behind it
+                if self.synced < target:
+                    with self.file_lock:
+                        log, end = self.log, self.appended
+                    os.fsync(log.fileno())
+                    self.synced = max(self.synced, end)
+        self.maybe_compact()
+
+    def sync_loop(self):
+        event = threading.Event()
+        while not event.wait(FSYNC_INTERVAL):
+            if self.synced < self.appended:
+                with self.file_lock:
+                    log, end = self.log, self.appended
+                os.fsync(log.fileno())
+                self.synced = max(self.synced, end)
+
+    def map_snapshot(self):
+        """ Maps the snapshot, returns (mapping, {key: _OnDisk} in key order), None if there is none """
+        name = os.path.join(self.path, 'snapshot')
+        if not os.path.exists(name) or os.path.getsize(name) < SNAPSHOT_FOOTER.size:
+            return None
+        with open(name, 'rb') as f:
+            snapshot = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_offset, count, width = SNAPSHOT_FOOTER.unpack_from(snapshot, len(snapshot) - SNAPSHOT_FOOTER.size)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('{} is not a chord snapshot'.format(name))
+        entry = struct.Struct('!{}sQI'.format(width))
+        index = snapshot[index_offset:index_offset + count * entry.size]
+        read = partial(_slice, snapshot)
+        return snapshot, {int.from_bytes(kb, 'big'): _OnDisk(read, offset, size) for kb, offset, size in entry.iter_unpack(index)}
+
+    def load_snapshot(self):
+        """ Rebuilds data and index from the snapshot's index section, values stay on disk """
+        mapped = self.map_snapshot()
+        if mapped is not None:
+            self.snapshot, self.data = mapped
+            self.index = SortedKeys(self.data)  # written in key order
+
+    def replay_log(self, log):
+        """ Applies a log on top of the snapshot; a torn record at the end (crash mid-write) is cut off """
+        size = os.fstat(log.fileno()).st_size
+        if not size:
+            return
+        read = partial(_pread, log)
+        with mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            pos = 0
+            puts = {}
+            deletes = set()
+            while pos + LOG_RECORD.size <= size:
+                crc, op, klen, vlen = LOG_RECORD.unpack_from(mapped, pos)
+                end = pos + LOG_RECORD.size + klen + vlen
+                if end > size or zlib.crc32(mapped[pos + 4:end]) != crc:
+                    break
+                key = int.from_bytes(mapped[pos + LOG_RECORD.size:pos + LOG_RECORD.size + klen], 'big')
+                if op == PUT:
+                    puts[key] = _OnDisk(read, end - vlen, vlen)
+                    deletes.discard(key)
+                else:
+                    puts.pop(key, None)
+                    deletes.add(key)
+                pos = end
+        if pos < size and 'a' in log.mode:
+            log.truncate(pos)
+        KeyStore.delete(self, deletes)
+        KeyStore.update(self, puts)
+
+    def disk_usage(self):
+        """ Bytes in the log and in the snapshot """
+        with self.file_lock:
+            return {'log_bytes': self.log_size,
+                    'snapshot_bytes': len(self.snapshot) if self.snapshot is not None else 0}
+
+    def maybe_compact(self):
+        """ Starts compact on a thread of its own once the log has passed snapshot_bytes """
+        with self.file_lock:
+            if self.log_size < self.snapshot_bytes or self.pending or self.compacting:
+                return
+            self.compacting = True
+        threading.Thread(target=self.compact, daemon=True).start()
+
+    def compact(self):
+        """
+        Writes every live key to a new snapshot, swaps it in atomically and drops the log it covers
+        Under file_lock the log is renamed to log.compacting and a new one started, and the live
+        values are listed; the snapshot is written from that list without the lock, while writes go
+        on into the new log; then the values not overwritten meanwhile are pointed at the snapshot.
+        Needs self.compacting set by the caller
+        """
+        name = os.path.join(self.path, 'snapshot')
+        try:
+            with self.file_lock:
+                if self.pending:  # a streamed value is in the log but not yet indexed, try again later
+                    return
+                if not os.path.exists(self.log_name('compacting')):  # else a compaction cut short, redone as it is
+                    os.fsync(self.log.fileno())
+                    self.synced = max(self.synced, self.appended)
+                    os.rename(self.log_name(), self.log_name('compacting'))
+                    self.log = open(self.log_name(), 'a+b')
+                    self.read_log = partial(_pread, self.log)
+                    self.log_size = 0
+                    self.sync_dir()
+                live = [(key, self.data[key]) for key in self.index]
+            width = (live[-1][0].bit_length() + 7) // 8 if live else 1
+            entry = struct.Struct('!{}sQI'.format(width or 1))
+            entries = []
+            with open(name + '.tmp', 'wb') as f:
+                offset = 0
+                for key, stored in live:
+                    if type(stored) is _OnDisk:  # copied in pieces, a large value is never read in whole
+                        for piece in stored.pieces():
+                            f.write(piece)
+                        size = stored.size
+                    else:
+                        raw = encode(stored)
+                        f.write(raw)
+                        size = len(raw)
+                    entries.append(entry.pack(key.to_bytes(entry.size - 12, 'big'), offset, size))
+                    offset += size
+                f.write(b''.join(entries))
+                f.write(SNAPSHOT_FOOTER.pack(SNAPSHOT_MAGIC, offset, len(entries), entry.size - 12))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(name + '.tmp', name)
+            self.sync_dir()
+            snapshot, fresh = self.map_snapshot()
+            with self.file_lock:
+                for key, stored in live:
+                    if self.data.get(key) is stored:
+                        self.data[key] = fresh[key]
+                self.snapshot = snapshot  # the old mapping closes once no value refers to it
+                os.unlink(self.log_name('compacting'))
+        finally:
+            self.compacting = False
+
+    def sync_dir(self):
+        """ fsync of the directory, so renames and new files in it survive a crash """
+        dir_fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class ValueCache(object):
+    """
+    Bounded LRU cache of key -> (version, value) for reads of hot keys.
+
+    An entry is fresh for ttl seconds after it was stored or revalidated (forever if ttl is None);
+    after that lookup still returns it, marked stale, so the caller can ask the owner whether its
+    version is still current instead of fetching the value again. Past capacity entries the least
+    recently used one is evicted.
+
+    A read races with invalidations: the reply to a read sent before a key was invalidated may
+    arrive after it. So a caller takes a ticket() before it reads, and put and touch ignore a key
+    invalidated since that ticket; put never replaces a higher version either. The keys invalidated
+    are remembered up to capacity of them, a ticket older than the last one forgotten is refused.
+
+    >>> vc = ValueCache(capacity=2, ttl=None)
+    >>> vc.put(1, 10, 'a'); vc.put(2, 11, 'b'); vc.lookup(1)
+    (10, 'a', True)
+    >>> vc.put(3, 12, 'c'); vc.lookup(2), len(vc)
+    (None, 2)
+    >>> ticket = vc.ticket()
+    >>> vc.invalidate([1]); vc.lookup(1)
+    >>> vc.put(1, 10, 'a', ticket); vc.lookup(1)
+    >>> vc.put(3, 11, 'old'); vc.lookup(3)
+    (12, 'c', True)
+    >>> sorted(vc.stats().items())
+    [('evictions', 1), ('hits', 2), ('invalidations', 1), ('misses', 3), ('size', 1), ('stale', 0)]
+    """
+
+    def __init__(self, capacity=CACHE_SIZE, ttl=None, clock=time.monotonic):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()  # key -> [version, value, time stored], least recently used first
+        self.epoch = 0  # bumped by every invalidate, see ticket
+        self.dropped = OrderedDict()  # key -> epoch it was last invalidated in, oldest first, at most capacity
+        self.forgotten = 0  # newest epoch pushed out of dropped
+        self.lock = threading.Lock()
+        self.hits = self.stale = self.misses = self.evictions = self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, key):
+        """ (version, value, fresh) for a cached key, None if it is not cached """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            fresh = self.ttl is None or self.clock() - entry[2] < self.ttl
+            if fresh:
+                self.hits += 1
+            else:
+                self.stale += 1
+            return entry[0], entry[1], fresh
+
+    def ticket(self):
+        """ To take before reading keys from their owners, and pass to put and touch with what was read """
+        return self.epoch
+
+    def invalidated_since(self, key, ticket):
+        return ticket is not None and (self.forgotten > ticket or self.dropped.get(key, 0) > ticket)
+
+    def put(self, key, version, value, ticket=None):
+        with self.lock:
+            if self.invalidated_since(key, ticket):
+                return
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > version:
+                return
+            self.entries[key] = [version, value, self.clock()]
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def entry(self, key):
+        """ (version, value) of the cached copy of key or None, without counting as a lookup """
+        with self.lock:
+            entry = self.entries.get(key)
+            return (entry[0], entry[1]) if entry is not None else None
+
+    def touch(self, key, version, ticket=None):
+        """ The owner confirmed version of key as current, an entry still holding it is fresh again """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version and not self.invalidated_since(key, ticket):
+                entry[2] = self.clock()
+
+    def invalidate(self, keys):
+        with self.lock:
+            self.epoch += 1
+            for key in keys:
+                if self.entries.pop(key, None) is not None:
+                    self.invalidations += 1
+                self.dropped[key] = self.epoch
+                self.dropped.move_to_end(key)
+            while len(self.dropped) > self.capacity:
+                self.forgotten = max(self.forgotten, self.dropped.popitem(last=False)[1])
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'stale': self.stale, 'misses': self.misses,
+                    'evictions': self.evictions, 'invalidations': self.invalidations, 'size': len(self.entries)}